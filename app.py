@@ -4,23 +4,69 @@ A secure patient records management system with encrypted data storage.
 Uses Flask + SQLite (free database) + Cryptography for encryption.
 """
 
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Flask, render_template, request, redirect, url_for, flash, session, abort, Response, jsonify, g, has_app_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSQLAlchemySession
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.schema import CreateIndex
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+import atexit
 import base64
+import gzip
+import hmac
 import json
 import os
-from datetime import datetime
+import queue
+import re
+import secrets
+import sqlite3
+import threading
+import time
+import urllib.parse
+import urllib.request
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
 from functools import wraps
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.urandom(24)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///medical_records.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# The access audit log lives in its own database file
+app.config['SQLALCHEMY_BINDS'] = {'audit': 'sqlite:///audit_log.db'}
+# Multi-site sync: every install needs its own site id; the central server
+# only accepts /sync requests carrying the shared token
+app.config['SITE_ID'] = os.environ.get('VITALSIGNS_SITE_ID', 'central')
+app.config['SYNC_TOKEN'] = os.environ.get('VITALSIGNS_SYNC_TOKEN')
+# Rate limit state is per process unless a shared SQLite file is configured
+# (needed when running several workers, e.g. gunicorn -w 4)
+app.config['RATE_LIMIT_DB'] = os.environ.get('VITALSIGNS_RATE_LIMIT_DB')
+# Write routes commit through the single group-commit writer (see GROUP COMMIT WRITER)
+app.config['GROUP_COMMIT'] = os.environ.get('VITALSIGNS_GROUP_COMMIT', '1') != '0'
+# Visits older than this move to medical_records_archive.db (see VISIT ARCHIVE)
+app.config['ARCHIVE_AFTER_DAYS'] = int(os.environ.get('VITALSIGNS_ARCHIVE_AFTER_DAYS', 2 * 365))
+# Multi-campus mode: one SQLite file per tenant, picked by path prefix
+# (/arlington/...) or subdomain (arlington.example.org); off when empty
+app.config['TENANT_MODE'] = os.environ.get('VITALSIGNS_TENANT_MODE', '')  # '', 'path' or 'subdomain'
+app.config['TENANTS'] = [name.strip().lower() for name in os.environ.get('VITALSIGNS_TENANTS', '').split(',')
+                         if name.strip()]
+app.config['TENANT_DATA_DIR'] = os.path.join(app.instance_path, 'tenants')
 
-db = SQLAlchemy(app)
+class TenantSession(FlaskSQLAlchemySession):
+    """Session that sends queries to the current tenant's engines (see MULTI-TENANCY)"""
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        engine = super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        if bind is not None or current_tenant() is None:
+            return engine
+        bind_key = next(key for key, default in self._db.engines.items() if default is engine)
+        return get_engine(bind_key)
+
+db = SQLAlchemy(app, session_options={'class_': TenantSession})
 
 # ==================== MODELS ====================
 
@@ -41,16 +87,251 @@ class Patient(db.Model):
     encrypted_data = db.Column(db.Text, nullable=False)  # Encrypted patient details
     physician_staff_number = db.Column(db.String(20), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Sync metadata: the site that registered the patient and the local change sequence
+    site_id = db.Column(db.String(64))
+    change_seq = db.Column(db.Integer, default=0, index=True)
+    # Denormalized visit summary for the physician dashboard, maintained by add_visit() and sync
+    visit_count = db.Column(db.Integer, nullable=False, default=0)
+    last_visit_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        # Covers the whole physician panel listing: no table lookups, no decryption
+        db.Index('ix_patient_physician_panel', 'physician_staff_number', 'last_visit_at', 'visit_count'),
+    )
     
 class Visit(db.Model):
     """Patient visit records (encrypted)"""
     id = db.Column(db.Integer, primary_key=True)
-    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False, index=True)
     encrypted_data = db.Column(db.Text, nullable=False)  # Encrypted visit details
-    visit_date = db.Column(db.DateTime, default=datetime.utcnow)
+    visit_date = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    # Sync metadata: the recording site, the visit id on that site and the local change sequence
+    site_id = db.Column(db.String(64))
+    origin_id = db.Column(db.Integer)
+    change_seq = db.Column(db.Integer, default=0, index=True)
     
     patient = db.relationship('Patient', backref=db.backref('visits', lazy=True))
 
+    __table_args__ = (
+        db.Index('ix_visit_site_origin', 'site_id', 'origin_id', unique=True),
+    )
+
+class AccessAudit(db.Model):
+    """Append-only record of staff access to patient records"""
+    __bind_key__ = 'audit'
+    id = db.Column(db.Integer, primary_key=True)
+    staff_number = db.Column(db.String(20), index=True)
+    patient_id = db.Column(db.Integer, index=True)
+    route = db.Column(db.String(50), nullable=False)
+    outcome = db.Column(db.String(30), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class MaintenanceRun(db.Model):
+    """Outcome of a background database maintenance job"""
+    id = db.Column(db.Integer, primary_key=True)
+    job = db.Column(db.String(50), nullable=False)
+    started_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    duration_ms = db.Column(db.Integer, nullable=False, default=0)
+    outcome = db.Column(db.String(20), nullable=False)  # ok, failed, timeout
+    detail = db.Column(db.Text)
+
+    __table_args__ = (
+        db.Index('ix_maintenance_run_job_started', 'job', 'started_at'),
+    )
+
+class SyncState(db.Model):
+    """Sync counters: the local change sequence and per-server cursors"""
+    key = db.Column(db.String(255), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+class SchemaMigration(db.Model):
+    """Schema migrations applied to this database, and the position of unfinished backfills"""
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(100), nullable=False)
+    progress = db.Column(db.Integer, nullable=False, default=0)  # last row id backfilled
+    started_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    applied_at = db.Column(db.DateTime)  # NULL until the migration has finished
+
+
+# ==================== MULTI-TENANCY ====================
+#
+# With TENANT_MODE set, one process serves several campuses. Each request is
+# assigned a tenant from an allowlist, and the session routes its queries to
+# that tenant's own engines (medical_records.db and audit_log.db under
+# TENANT_DATA_DIR/<tenant>/). Engines are created on first use with small
+# pools, closed after TENANT_IDLE_TIMEOUT, and at most TENANT_MAX_ENGINES
+# tenants are open at once. A tenant is set up (and migrated) outside the
+# registry lock, so opening one campus never stalls requests for the others.
+# Background workers capture the tenant when work is queued and re-enter it
+# with tenant_context(); scheduled maintenance only visits tenants that are
+# already open and does not keep them open.
+
+TENANT_NAME = re.compile(r'^[a-z0-9][a-z0-9-]{0,62}$')
+TENANT_MAX_ENGINES = 16
+TENANT_IDLE_TIMEOUT = 10 * 60
+TENANT_POOL_SIZE = 2
+TENANT_MAX_OVERFLOW = 3
+
+for _tenant in app.config['TENANTS']:
+    if not TENANT_NAME.match(_tenant):
+        raise ValueError(f'Invalid tenant name: {_tenant!r}')
+
+def current_tenant():
+    """The tenant of the current request or background job (None outside tenant mode)"""
+    return g.get('tenant') if has_app_context() else None
+
+@contextmanager
+def tenant_context(tenant, scheduled=False):
+    """App context for background work on behalf of a tenant
+
+    Scheduled work never opens a closed tenant or counts as tenant activity.
+    """
+    with app.app_context():
+        g.tenant = tenant
+        g.tenant_scheduled = scheduled
+        yield
+
+class TenantClosed(Exception):
+    """Scheduled work reached a tenant that is not open"""
+
+class TenantEngines:
+    """Lazily opened per-tenant engines with an idle timeout and an LRU cap"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # tenant -> {'engines': {bind_key: engine}, 'last_used': t, 'ready': Event, 'opener': thread id, 'error': e}
+        self._tenants = OrderedDict()
+
+    def get(self, tenant, bind_key=None, scheduled=False):
+        with self._lock:
+            entry = self._tenants.get(tenant)
+            if entry is None and scheduled:
+                raise TenantClosed(tenant)
+            opening = entry is None
+            if opening:
+                entry = self._new_entry(tenant)
+                self._tenants[tenant] = entry
+            if not scheduled:
+                self._tenants.move_to_end(tenant)
+                entry['last_used'] = time.monotonic()
+                self.close_idle(keep=tenant)
+        if opening:
+            self._setup(tenant, entry)
+        elif not entry['ready'].is_set() and entry['opener'] != threading.get_ident():
+            # Someone else is setting this tenant up; only its own requests wait
+            entry['ready'].wait()
+        if entry['error'] is not None:
+            raise RuntimeError(f'Tenant {tenant} could not be opened') from entry['error']
+        return entry['engines'][bind_key]
+
+    def _new_entry(self, tenant):
+        directory = os.path.join(app.config['TENANT_DATA_DIR'], tenant)
+        os.makedirs(directory, exist_ok=True)
+        files = {None: 'medical_records.db', 'audit': 'audit_log.db'}
+        return {
+            'engines': {
+                bind_key: create_engine(
+                    f'sqlite:///{os.path.join(directory, filename)}',
+                    pool_size=TENANT_POOL_SIZE,
+                    max_overflow=TENANT_MAX_OVERFLOW
+                )
+                for bind_key, filename in files.items()
+            },
+            'last_used': time.monotonic(),
+            'ready': threading.Event(),
+            'opener': threading.get_ident(),
+            'error': None,
+        }
+
+    def _setup(self, tenant, entry):
+        """Create and migrate a newly opened tenant's databases (without holding the registry lock)"""
+        try:
+            with tenant_context(tenant):
+                setup_database()
+        except Exception as e:
+            entry['error'] = e
+            with self._lock:
+                if self._tenants.get(tenant) is entry:
+                    self._close(tenant)
+            raise
+        finally:
+            entry['ready'].set()
+
+    def close_idle(self, keep=None):
+        """Close tenants idle for too long, then the least recently used beyond the cap"""
+        with self._lock:
+            now = time.monotonic()
+            # Tenants still being set up are never closed under their opener
+            closable = [t for t, entry in self._tenants.items() if t != keep and entry['ready'].is_set()]
+            for tenant in closable:
+                if now - self._tenants[tenant]['last_used'] > TENANT_IDLE_TIMEOUT:
+                    self._close(tenant)
+            for tenant in closable:
+                if len(self._tenants) <= TENANT_MAX_ENGINES:
+                    break
+                if tenant in self._tenants:
+                    self._close(tenant)
+
+    def _close(self, tenant):
+        entry = self._tenants.pop(tenant, None)
+        if entry:
+            for engine in entry['engines'].values():
+                engine.dispose()
+
+    def open_tenants(self):
+        with self._lock:
+            return [tenant for tenant, entry in self._tenants.items() if entry['ready'].is_set()]
+
+tenant_engines = TenantEngines()
+
+def get_engine(bind_key=None):
+    """Engine for the current tenant, or the app's own database outside tenant mode"""
+    tenant = current_tenant()
+    if tenant is None:
+        return db.engines[bind_key]
+    return tenant_engines.get(tenant, bind_key, scheduled=g.get('tenant_scheduled', False))
+
+def active_tenants():
+    """Tenants to run scheduled jobs for: the open ones ([None] outside tenant mode)"""
+    return tenant_engines.open_tenants() if app.config['TENANT_MODE'] else [None]
+
+class TenantMiddleware:
+    """Resolve the tenant from the subdomain or the first path segment"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        tenants = app.config['TENANTS']
+        tenant = None
+        if app.config['TENANT_MODE'] == 'subdomain':
+            host = environ.get('HTTP_HOST', '').split(':')[0].lower()
+            tenant = host.split('.')[0] if host.count('.') >= 1 else None
+        elif app.config['TENANT_MODE'] == 'path':
+            segment, _, rest = environ.get('PATH_INFO', '').lstrip('/').partition('/')
+            if segment in tenants:
+                tenant = segment
+                # Moving the prefix into SCRIPT_NAME makes url_for() keep it
+                environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + '/' + segment
+                environ['PATH_INFO'] = '/' + rest
+        environ['vitalsigns.tenant'] = tenant if tenant in tenants else None
+        return self.wsgi_app(environ, start_response)
+
+if app.config['TENANT_MODE']:
+    app.wsgi_app = TenantMiddleware(app.wsgi_app)
+
+@app.before_request
+def resolve_tenant():
+    """Bind the request to its tenant; sessions never carry over between tenants"""
+    if not app.config['TENANT_MODE']:
+        return
+    g.tenant = request.environ.get('vitalsigns.tenant')
+    if g.tenant is None:
+        abort(404)
+    if session.get('tenant') != g.tenant:
+        session.clear()
+        session['tenant'] = g.tenant
+
 
 # ==================== ENCRYPTION UTILITIES ====================
 
@@ -83,16 +364,34 @@ def encrypt_data(data, first_name, last_name, dob):
     encrypted = f.encrypt(json_data.encode())
     return encrypted.decode()
 
-def decrypt_data(encrypted_data, first_name, last_name, dob):
-    """Decrypt data using patient credentials"""
+def decrypt_with_key(encrypted_data, key):
+    """Decrypt data with an already derived key (PBKDF2 runs once per patient, not per record)"""
     try:
-        key = generate_encryption_key(first_name, last_name, dob)
         f = Fernet(key)
         decrypted = f.decrypt(encrypted_data.encode())
         return json.loads(decrypted.decode())
     except Exception:
         return None
 
+def decrypt_visits(visits, key):
+    """Decrypt visit rows into display dicts, skipping any that cannot be read"""
+    decrypted = []
+    for visit in visits:
+        visit_data = decrypt_with_key(visit.encrypted_data, key)
+        if visit_data:
+            visit_data['id'] = visit.id
+            visit_data['visit_date'] = visit.visit_date.strftime('%Y-%m-%d %H:%M')
+            decrypted.append(visit_data)
+    return decrypted
+
+def session_patient_key():
+    """Derive the encryption key for the patient selected in this session"""
+    return generate_encryption_key(
+        session['patient_first'],
+        session['patient_last'],
+        session['patient_dob']
+    )
+
 def generate_lookup_hash(first_name, last_name, dob):
     """Generate a hash for patient lookup (allows name swap)"""
     # Normalize and sort names to allow first/last name swap
@@ -102,6 +401,71 @@ def generate_lookup_hash(first_name, last_name, dob):
     import hashlib
     return hashlib.sha256(combined.encode()).hexdigest()
 
+def record_visit_summary(patient_id, count, latest_visit):
+    """Add new visits to a patient's denormalized visit_count/last_visit_at (same transaction)"""
+    statement = text(
+        'UPDATE patient SET visit_count = COALESCE(visit_count, 0) + :count, '
+        'last_visit_at = MAX(COALESCE(last_visit_at, :latest), :latest) WHERE id = :id'
+    ).bindparams(db.bindparam('latest', type_=db.DateTime))
+    db.session.execute(statement, {'count': count, 'latest': latest_visit, 'id': patient_id})
+
+def panel_cursor(row):
+    """Keyset position of a physician panel row, for the page links"""
+    last_visit_at = row.last_visit_at.isoformat() if row.last_visit_at else ''
+    return f'{row.id}:{row.visit_count}:{last_visit_at}'
+
+def parse_panel_cursor(value):
+    """(last_visit_at, visit_count, id) from panel_cursor(), or None if missing or malformed"""
+    try:
+        patient_id, visit_count, last_visit_at = value.split(':', 2)
+        return (datetime.fromisoformat(last_visit_at) if last_visit_at else None,
+                int(visit_count), int(patient_id))
+    except (AttributeError, ValueError):
+        return None
+
+def panel_page(physician_number, after=None, before=None):
+    """
+    One page of a physician's panel, most recently seen first (ties: most visits,
+    then newest id), read by keyset from the row `after` or `before` a cursor.
+    Every query walks ix_patient_physician_panel in index order from the cursor,
+    so page 2000 costs what page 1 does. Patients never seen (NULL last_visit_at)
+    come last and are a range of their own, since NULL never compares.
+    Returns the rows and whether more follow in the direction read.
+    """
+    backwards = before is not None
+    cursor = before if backwards else after
+    seen = [Patient.last_visit_at.isnot(None)]
+    unseen = [Patient.last_visit_at.is_(None)]
+    if cursor is None:
+        ranges = [seen, unseen]
+    elif cursor[0] is not None:
+        key = db.tuple_(Patient.last_visit_at, Patient.visit_count, Patient.id)
+        seen.append(key > cursor if backwards else key < cursor)
+        ranges = [seen] if backwards else [seen, unseen]
+    else:
+        key = db.tuple_(Patient.visit_count, Patient.id)
+        unseen.append(key > cursor[1:] if backwards else key < cursor[1:])
+        ranges = [unseen, seen] if backwards else [unseen]
+
+    columns = (Patient.last_visit_at, Patient.visit_count, Patient.id)
+    order = [column.asc() if backwards else column.desc() for column in columns]
+    rows = []
+    for conditions in ranges:
+        # Only columns of ix_patient_physician_panel (plus the rowid) so SQLite never reads the table
+        rows += db.session.execute(
+            db.select(Patient.id, Patient.visit_count, Patient.last_visit_at)
+            .where(Patient.physician_staff_number == physician_number, *conditions)
+            .order_by(*order)
+            .limit(PANEL_PAGE_SIZE + 1 - len(rows))
+        ).all()
+        if len(rows) > PANEL_PAGE_SIZE:
+            break
+    more = len(rows) > PANEL_PAGE_SIZE
+    rows = rows[:PANEL_PAGE_SIZE]
+    if backwards:
+        rows.reverse()
+    return rows, more
+
 def find_patient(first_name, last_name, dob):
     """Find patient allowing for first/last name swap"""
     # Try both combinations
@@ -132,15 +496,256 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def api_staff_required(f):
+    """Decorator for JSON endpoints: staff session and a selected patient, else 401"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'staff_number' not in session or not session.get('patient_id'):
+            return jsonify({'error': 'Authenticate as staff and select a patient first.'}), 401
+        return f(*args, **kwargs)
+    return decorated_function
+
+def sync_token_required(f):
+    """Decorator to require the shared sync token (sync is disabled without one)"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        token = app.config.get('SYNC_TOKEN')
+        supplied = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+        if not token or not hmac.compare_digest(supplied.encode(), token.encode()):
+            abort(403)
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+# ==================== RATE LIMITING ====================
+#
+# Sliding-window budgets per client address for the routes that end in
+# PBKDF2 work, plus progressive lockout of a staff number after repeated
+# failed logins. Lockouts are kept per staff number and client address, so
+# a client guessing at a (well-known) staff number cannot lock that staff
+# member out everywhere else. State lives in process memory by default; setting
+# RATE_LIMIT_DB shares it between workers through a small SQLite file.
+
+# budget name -> (requests allowed, window in seconds), per client address
+RATE_LIMITS = {
+    'patient_auth': (30, 60),
+    'patient_records': (60, 60),
+    'staff_login': (10, 60),
+    'api': (120, 60),
+}
+STAFF_LOCKOUT_THRESHOLD = 3       # failed logins before the first lockout
+STAFF_LOCKOUT_BASE = 5            # seconds, doubled for every further failure
+STAFF_LOCKOUT_MAX = 15 * 60
+STAFF_FAILURE_RESET = 60 * 60     # forget failures after an hour without one
+
+rate_limit_stats = {'checked': 0, 'rejected': {}, 'lockouts': 0}
+
+def _lockout_seconds(failures):
+    if failures < STAFF_LOCKOUT_THRESHOLD:
+        return 0
+    return min(STAFF_LOCKOUT_BASE * 2 ** (failures - STAFF_LOCKOUT_THRESHOLD), STAFF_LOCKOUT_MAX)
+
+class RateLimiter:
+    """In-memory sliding-window limiter and failed-login tracker"""
+
+    PRUNE_EVERY = 10000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hits = {}
+        self._failures = {}  # key -> (failures, last failure, locked until)
+        self._calls = 0
+
+    def hit(self, key, limit, window):
+        """Count a request; return 0 if allowed, else seconds until retry"""
+        now = time.monotonic()
+        with self._lock:
+            self._calls += 1
+            if self._calls % self.PRUNE_EVERY == 0:
+                self._prune(now)
+            hits = self._hits.setdefault(key, deque())
+            while hits and hits[0] <= now - window:
+                hits.popleft()
+            if len(hits) >= limit:
+                return hits[0] + window - now
+            hits.append(now)
+            return 0
+
+    def lockout_remaining(self, key):
+        with self._lock:
+            _, _, locked_until = self._failures.get(key, (0, 0, 0))
+        return max(0, locked_until - time.monotonic())
+
+    def record_failure(self, key):
+        """Count a failed login and return the resulting lockout in seconds"""
+        now = time.monotonic()
+        with self._lock:
+            failures, last, _ = self._failures.get(key, (0, 0, 0))
+            if now - last > STAFF_FAILURE_RESET:
+                failures = 0
+            failures += 1
+            lockout = _lockout_seconds(failures)
+            self._failures[key] = (failures, now, now + lockout)
+        return lockout
+
+    def clear_failures(self, key):
+        with self._lock:
+            self._failures.pop(key, None)
+
+    def _prune(self, now):
+        longest = max(window for _, window in RATE_LIMITS.values())
+        for key in [k for k, hits in self._hits.items() if not hits or hits[-1] <= now - longest]:
+            del self._hits[key]
+        for key in [k for k, (_, last, _) in self._failures.items() if now - last > STAFF_FAILURE_RESET]:
+            del self._failures[key]
+
+class SQLiteRateLimiter(RateLimiter):
+    """Same limits, with state shared between worker processes through SQLite"""
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as connection:
+            connection.executescript(
+                'CREATE TABLE IF NOT EXISTS hits (key TEXT NOT NULL, ts REAL NOT NULL);'
+                'CREATE INDEX IF NOT EXISTS ix_hits_key_ts ON hits (key, ts);'
+                'CREATE TABLE IF NOT EXISTS failures ('
+                ' key TEXT PRIMARY KEY, failures INTEGER NOT NULL,'
+                ' last_failure REAL NOT NULL, locked_until REAL NOT NULL);')
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def _transaction(self):
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        return connection
+
+    def hit(self, key, limit, window):
+        now = time.time()  # wall clock, shared between processes
+        with self._lock:
+            self._calls += 1
+            prune = self._calls % self.PRUNE_EVERY == 0
+        if prune:
+            self._prune(now)
+        connection = self._transaction()
+        try:
+            connection.execute('DELETE FROM hits WHERE key = ? AND ts <= ?', (key, now - window))
+            count, oldest = connection.execute(
+                'SELECT COUNT(*), MIN(ts) FROM hits WHERE key = ?', (key,)).fetchone()
+            if count >= limit:
+                return oldest + window - now
+            connection.execute('INSERT INTO hits (key, ts) VALUES (?, ?)', (key, now))
+            return 0
+        finally:
+            connection.execute('COMMIT')
+
+    def lockout_remaining(self, key):
+        row = self._connect().execute(
+            'SELECT locked_until FROM failures WHERE key = ?', (key,)).fetchone()
+        return max(0, row[0] - time.time()) if row else 0
+
+    def record_failure(self, key):
+        now = time.time()
+        connection = self._transaction()
+        try:
+            row = connection.execute(
+                'SELECT failures, last_failure FROM failures WHERE key = ?', (key,)).fetchone()
+            failures = row[0] if row and now - row[1] <= STAFF_FAILURE_RESET else 0
+            failures += 1
+            lockout = _lockout_seconds(failures)
+            connection.execute(
+                'INSERT OR REPLACE INTO failures (key, failures, last_failure, locked_until) '
+                'VALUES (?, ?, ?, ?)', (key, failures, now, now + lockout))
+            return lockout
+        finally:
+            connection.execute('COMMIT')
+
+    def clear_failures(self, key):
+        self._connect().execute('DELETE FROM failures WHERE key = ?', (key,))
+
+    def _prune(self, now):
+        # hit() only trims its own key; clients that never come back are removed here
+        longest = max(window for _, window in RATE_LIMITS.values())
+        connection = self._connect()
+        connection.execute('DELETE FROM hits WHERE ts <= ?', (now - longest,))
+        connection.execute('DELETE FROM failures WHERE last_failure < ? AND locked_until < ?',
+                           (now - STAFF_FAILURE_RESET, now))
+
+if app.config['RATE_LIMIT_DB']:
+    rate_limiter = SQLiteRateLimiter(app.config['RATE_LIMIT_DB'])
+else:
+    rate_limiter = RateLimiter()
+
+def _limit_key(kind, value):
+    """Limiter key scoped to the current tenant: campuses never share budgets or lockouts"""
+    return f'{current_tenant() or ""}:{kind}:{value}'
+
+def _staff_key(staff_number):
+    return _limit_key('staff', f'{staff_number.lower()}@{request.remote_addr}')
+
+def check_rate_limit(budget):
+    """Count this request against a per-client budget; return seconds to wait (0 = allowed)"""
+    limit, window = RATE_LIMITS[budget]
+    rate_limit_stats['checked'] += 1
+    retry_after = rate_limiter.hit(_limit_key(budget, request.remote_addr), limit, window)
+    if retry_after:
+        rate_limit_stats['rejected'][budget] = rate_limit_stats['rejected'].get(budget, 0) + 1
+    return retry_after
+
+def staff_lockout_remaining(staff_number):
+    """Seconds a staff number stays locked out for this client after failed logins"""
+    remaining = rate_limiter.lockout_remaining(_staff_key(staff_number))
+    if remaining:
+        rate_limit_stats['rejected']['staff_lockout'] = rate_limit_stats['rejected'].get('staff_lockout', 0) + 1
+    return remaining
+
+def record_failed_login(staff_number):
+    if rate_limiter.record_failure(_staff_key(staff_number)):
+        rate_limit_stats['lockouts'] += 1
+
+def clear_failed_logins(staff_number):
+    rate_limiter.clear_failures(_staff_key(staff_number))
+
+def too_many_requests(retry_after):
+    """429 page telling the user how long to wait"""
+    retry_after = max(1, int(retry_after + 0.999))
+    response = Response(render_template('rate_limited.html', retry_after=retry_after), status=429)
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def rate_limited(budget, methods=('GET', 'POST')):
+    """Decorator to apply a per-client request budget to a route"""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if request.method in methods:
+                retry_after = check_rate_limit(budget)
+                if retry_after:
+                    return too_many_requests(retry_after)
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
 
 # ==================== ROUTES ====================
 
+PANEL_PAGE_SIZE = 50
+
 @app.route('/')
 def index():
     """Welcome page with church name, vital signs, and navigation links"""
     return render_template('index.html')
 
 @app.route('/patient-auth', methods=['GET', 'POST'])
+@rate_limited('patient_auth', methods=('POST',))
 def patient_auth():
     """Authentication page for accessing patient records"""
     if request.method == 'POST':
@@ -150,11 +755,19 @@ def patient_auth():
         patient_last = request.form.get('patient_last', '').strip()
         patient_dob = request.form.get('patient_dob', '').strip()
         
+        locked_for = staff_lockout_remaining(staff_number)
+        if locked_for:
+            record_access('patient_auth', 'locked_out', staff_number=staff_number)
+            return too_many_requests(locked_for)
+        
         # Verify staff credentials
         staff = Staff.query.filter_by(staff_number=staff_number).first()
         if not staff or staff.last_name.lower() != staff_last_name.lower():
+            record_failed_login(staff_number)
+            record_access('patient_auth', 'denied', staff_number=staff_number)
             flash('Invalid staff credentials. Please try again.', 'danger')
             return render_template('patient_auth.html')
+        clear_failed_logins(staff_number)
         
         # Store staff info in session
         session['staff_number'] = staff_number
@@ -165,13 +778,17 @@ def patient_auth():
         patient = find_patient(patient_first, patient_last, patient_dob)
         
         if patient:
+            record_access('patient_auth', 'found', patient_id=patient.id)
             # Store patient credentials for decryption
             session['patient_id'] = patient.id
             session['patient_first'] = patient_first
             session['patient_last'] = patient_last
             session['patient_dob'] = patient_dob
+            # Start decrypting while the browser follows the redirect
+            start_prefetch(patient.id, patient_first, patient_last, patient_dob)
             return redirect(url_for('patient_records'))
         else:
+            record_access('patient_auth', 'not_found')
             # Patient not found
             session['temp_patient_first'] = patient_first
             session['temp_patient_last'] = patient_last
@@ -208,6 +825,7 @@ def create_patient():
         # Check if patient already exists
         existing = find_patient(first_name, last_name, dob)
         if existing:
+            record_access('create_patient', 'duplicate', patient_id=existing.id)
             flash('Patient already exists in the system.', 'warning')
             return render_template('create_patient.html')
         
@@ -222,19 +840,27 @@ def create_patient():
         encrypted = encrypt_data(patient_data, first_name, last_name, dob)
         lookup_hash = generate_lookup_hash(first_name, last_name, dob)
         
-        new_patient = Patient(
-            lookup_hash=lookup_hash,
-            encrypted_data=encrypted,
-            physician_staff_number=physician_number
-        )
+        def insert_patient():
+            new_patient = Patient(
+                lookup_hash=lookup_hash,
+                encrypted_data=encrypted,
+                physician_staff_number=physician_number
+            )
+            db.session.add(new_patient)
+            return new_patient
         
-        db.session.add(new_patient)
-        db.session.commit()
+        try:
+            patient_id = commit_write(insert_patient)
+        except IntegrityError:
+            # Registered by someone else since the check above
+            flash('Patient already exists in the system.', 'warning')
+            return render_template('create_patient.html')
+        record_access('create_patient', 'created', patient_id=patient_id)
         
         flash('Patient record created successfully!', 'success')
         
         # Set session for immediate access
-        session['patient_id'] = new_patient.id
+        session['patient_id'] = patient_id
         session['patient_first'] = first_name
         session['patient_last'] = last_name
         session['patient_dob'] = dob
@@ -253,6 +879,7 @@ def create_patient():
 
 @app.route('/patient-records')
 @staff_required
+@rate_limited('patient_records')
 def patient_records():
     """Display patient records and visits"""
     patient_id = session.get('patient_id')
@@ -262,45 +889,60 @@ def patient_records():
     
     patient = Patient.query.get(patient_id)
     if not patient:
+        record_access('patient_records', 'missing', patient_id=patient_id)
         flash('Patient not found.', 'danger')
         return redirect(url_for('patient_auth'))
     
-    # Decrypt patient data
-    patient_data = decrypt_data(
-        patient.encrypted_data,
-        session['patient_first'],
-        session['patient_last'],
-        session['patient_dob']
-    )
+    # Decrypt patient data (usually already done by the prefetch from patient_auth)
+    prefetched = take_prefetch(patient_id)
+    if prefetched:
+        key = prefetched['key']
+        patient_data = prefetched['patient']
+    else:
+        key = session_patient_key()
+        patient_data = decrypt_with_key(patient.encrypted_data, key)
     
     if not patient_data:
+        record_access('patient_records', 'decrypt_failed', patient_id=patient_id)
         flash('Unable to decrypt patient records. Please verify credentials.', 'danger')
         return redirect(url_for('patient_auth'))
     
     # Get physician info
     physician = Staff.query.filter_by(staff_number=patient.physician_staff_number).first()
     
-    # Decrypt all visits
-    visits = []
-    for visit in patient.visits:
-        visit_data = decrypt_data(
-            visit.encrypted_data,
-            session['patient_first'],
-            session['patient_last'],
-            session['patient_dob']
-        )
-        if visit_data:
-            visit_data['id'] = visit.id
-            visit_data['visit_date'] = visit.visit_date.strftime('%Y-%m-%d %H:%M')
-            visits.append(visit_data)
+    # Decrypt all recent visits, unless the prefetched ones are still current
+    stats = visit_stats(patient_id)
+    if prefetched and prefetched['stats'] == stats:
+        visits = prefetched['visits']
+    else:
+        if prefetched:
+            prefetch_stats['stale'] += 1
+        visits = decrypt_visits(patient.visits, key)
     
     # Sort visits by date (most recent first)
     visits.sort(key=lambda x: x['visit_date'], reverse=True)
     
+    # Archived visits are only read when the user pages back to them
+    archived_total = max(patient.visit_count - stats[1], 0)
+    if archived_total and not archive_available():
+        flash(f'{archived_total} older visits are archived in medical_records_archive.db, '
+              'which is missing. Copy it next to medical_records.db to see them.', 'warning')
+        archived_total = 0
+    older_pages = request.args.get('older', 0, type=int)
+    archived_shown = 0
+    if archived_total and older_pages > 0:
+        archived = load_archived_visits(patient_id, older_pages * ARCHIVE_PAGE_SIZE)
+        archived_shown = len(archived)
+        visits.extend(decrypt_visits(archived, key))
+    record_access('patient_records', 'viewed', patient_id=patient_id)
+    
     return render_template('patient_records.html', 
                            patient=patient_data, 
                            physician=physician,
-                           visits=visits)
+                           visits=visits,
+                           visit_total=stats[1] + archived_total,
+                           archived_remaining=archived_total - archived_shown,
+                           older_pages=older_pages)
 
 @app.route('/add-visit', methods=['GET', 'POST'])
 @staff_required
@@ -331,19 +973,56 @@ def add_visit():
             session['patient_dob']
         )
         
-        new_visit = Visit(
-            patient_id=patient_id,
-            encrypted_data=encrypted
-        )
+        def insert_visit():
+            new_visit = Visit(
+                patient_id=patient_id,
+                encrypted_data=encrypted,
+                visit_date=datetime.utcnow()
+            )
+            db.session.add(new_visit)
+            record_visit_summary(patient_id, 1, new_visit.visit_date)
+            return new_visit
         
-        db.session.add(new_visit)
-        db.session.commit()
+        commit_write(insert_visit)
+        record_access('add_visit', 'visit_added', patient_id=patient_id)
         
         flash('Visit record added successfully!', 'success')
         return redirect(url_for('patient_records'))
     
     return render_template('add_visit.html')
 
+@app.route('/physician-dashboard')
+@staff_required
+def physician_dashboard():
+    """A physician's patient panel, most recently seen first (nothing is decrypted)"""
+    physician_number = session['staff_number']
+    if session.get('is_admin'):
+        physician_number = request.args.get('physician', physician_number).strip()
+    physician = Staff.query.filter_by(staff_number=physician_number).first()
+    
+    total = db.session.execute(db.select(db.func.count()).select_from(Patient).where(
+        Patient.physician_staff_number == physician_number)).scalar()
+    # Pages are keyset cursors; the page number is only shown
+    after = parse_panel_cursor(request.args.get('after'))
+    before = parse_panel_cursor(request.args.get('before'))
+    page = max(request.args.get('page', 1, type=int), 1)
+    patients, more = panel_page(physician_number, after, before)
+    if before is not None:
+        has_previous, has_next = more, bool(patients)
+        page = page if more else 1
+    else:
+        has_previous, has_next = after is not None, more
+    
+    return render_template('physician_dashboard.html',
+                           physician=physician,
+                           physician_number=physician_number,
+                           patients=patients,
+                           total=total,
+                           page=page,
+                           pages=max((total + PANEL_PAGE_SIZE - 1) // PANEL_PAGE_SIZE, 1),
+                           previous_cursor=panel_cursor(patients[0]) if has_previous and patients else None,
+                           next_cursor=panel_cursor(patients[-1]) if has_next and patients else None)
+
 @app.route('/staff-admin', methods=['GET', 'POST'])
 def staff_admin():
     """Admin page for managing staff records"""
@@ -354,12 +1033,18 @@ def staff_admin():
             admin_number = request.form.get('admin_number', '').strip()
             admin_last = request.form.get('admin_last', '').strip()
             
+            retry_after = check_rate_limit('staff_login') or staff_lockout_remaining(admin_number)
+            if retry_after:
+                return too_many_requests(retry_after)
+            
             admin = Staff.query.filter_by(staff_number=admin_number, is_admin=True).first()
             if admin and admin.last_name.lower() == admin_last.lower():
+                clear_failed_logins(admin_number)
                 session['is_admin'] = True
                 session['admin_name'] = f"{admin.first_name} {admin.last_name}"
                 flash(f'Welcome, {admin.first_name}!', 'success')
             else:
+                record_failed_login(admin_number)
                 flash('Invalid admin credentials.', 'danger')
         
         elif action == 'add_staff' and session.get('is_admin'):
@@ -373,30 +1058,55 @@ def staff_admin():
             elif Staff.query.filter_by(staff_number=staff_number).first():
                 flash('Staff number already exists.', 'danger')
             else:
-                new_staff = Staff(
-                    staff_number=staff_number,
-                    first_name=first_name,
-                    last_name=last_name,
-                    is_admin=is_admin
-                )
-                db.session.add(new_staff)
-                db.session.commit()
-                flash(f'Staff member {first_name} {last_name} added successfully!', 'success')
+                def insert_staff():
+                    new_staff = Staff(
+                        staff_number=staff_number,
+                        first_name=first_name,
+                        last_name=last_name,
+                        is_admin=is_admin
+                    )
+                    db.session.add(new_staff)
+                    return new_staff
+                
+                try:
+                    commit_write(insert_staff)
+                    flash(f'Staff member {first_name} {last_name} added successfully!', 'success')
+                except IntegrityError:
+                    flash('Staff number already exists.', 'danger')
+        
+        elif action == 'run_maintenance' and session.get('is_admin'):
+            job = request.form.get('job')
+            if job in MAINTENANCE_JOBS:
+                run = run_maintenance_job(job)
+                flash(f'{job}: {run.outcome} in {run.duration_ms} ms ({run.detail})',
+                      'success' if run.outcome == 'ok' else 'warning')
         
         elif action == 'delete_staff' and session.get('is_admin'):
             staff_id = request.form.get('staff_id')
             staff = Staff.query.get(staff_id)
             if staff:
-                db.session.delete(staff)
-                db.session.commit()
+                def delete_staff():
+                    removed = db.session.get(Staff, staff.id)
+                    if removed:
+                        db.session.delete(removed)
+                    return removed
+                
+                commit_write(delete_staff)
                 flash('Staff member removed.', 'success')
     
     staff_list = Staff.query.all() if session.get('is_admin') else []
-    return render_template('staff_admin.html', staff_list=staff_list)
+    maintenance_runs = []
+    if session.get('is_admin'):
+        maintenance_runs = MaintenanceRun.query.order_by(MaintenanceRun.id.desc()).limit(10).all()
+    return render_template('staff_admin.html',
+                           staff_list=staff_list,
+                           maintenance_jobs=MAINTENANCE_JOBS,
+                           maintenance_runs=maintenance_runs)
 
 @app.route('/logout')
 def logout():
     """Clear session and logout"""
+    discard_prefetch()
     session.clear()
     flash('You have been logged out.', 'info')
     return redirect(url_for('index'))
@@ -404,31 +1114,1292 @@ def logout():
 @app.route('/clear-patient')
 def clear_patient():
     """Clear patient from session but keep staff logged in"""
+    discard_prefetch()
     session.pop('patient_id', None)
     session.pop('patient_first', None)
     session.pop('patient_last', None)
     session.pop('patient_dob', None)
     return redirect(url_for('patient_auth'))
 
+@app.route('/admin/metrics')
+@admin_required
+def admin_metrics():
+    """Runtime counters for admins (JSON)"""
+    return jsonify({
+        'audit': audit_stats,
+        'rate_limits': rate_limit_stats,
+        'prefetch': dict(prefetch_stats, hit_rate=prefetch_hit_rate()),
+        'writes': write_metrics(),
+        'schema_version': schema_version(),
+    })
+
+
+# ==================== ACCESS AUDIT LOG ====================
+#
+# Views never write audit rows themselves. They append events to a bounded
+# in-memory queue and a background writer inserts them into the separate
+# audit database in grouped transactions every AUDIT_FLUSH_INTERVAL seconds.
+# A crash loses at most one interval of events; a clean exit flushes them all.
+
+AUDIT_FLUSH_INTERVAL = 1.0
+AUDIT_BATCH_SIZE = 500
+AUDIT_QUEUE_SIZE = 10000
+AUDIT_PAGE_SIZE = 50
+
+audit_queue = queue.Queue(maxsize=AUDIT_QUEUE_SIZE)
+audit_stats = {'queued': 0, 'written': 0, 'failed': 0, 'flushes': 0}
+_audit_flush_lock = threading.Lock()
+_audit_writer_lock = threading.Lock()
+_audit_writer = None
+
+def record_access(route, outcome, patient_id=None, staff_number=None):
+    """Queue an audit event; the current staff member is used by default"""
+    _start_audit_writer()
+    entry = {
+        'staff_number': staff_number or session.get('staff_number'),
+        'patient_id': patient_id,
+        'route': route,
+        'outcome': outcome,
+        'created_at': datetime.utcnow(),
+    }
+    item = (current_tenant(), entry)
+    try:
+        audit_queue.put_nowait(item)
+    except queue.Full:
+        # Writer is behind: apply back-pressure instead of dropping the event
+        flush_audit_log()
+        audit_queue.put(item)
+    audit_stats['queued'] += 1
+
+def flush_audit_log():
+    """Write every queued audit event, one transaction per batch"""
+    with _audit_flush_lock:
+        while True:
+            batch = []
+            while len(batch) < AUDIT_BATCH_SIZE:
+                try:
+                    batch.append(audit_queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                return
+            by_tenant = {}
+            for tenant, entry in batch:
+                by_tenant.setdefault(tenant, []).append(entry)
+            for tenant, entries in by_tenant.items():
+                try:
+                    with tenant_context(tenant):
+                        with get_engine('audit').begin() as connection:
+                            connection.execute(AccessAudit.__table__.insert(), entries)
+                except Exception:
+                    audit_stats['failed'] += len(entries)
+                    app.logger.exception('Failed to write %d audit events', len(entries))
+                    continue
+                audit_stats['written'] += len(entries)
+                audit_stats['flushes'] += 1
+
+def _audit_writer_loop():
+    while True:
+        time.sleep(AUDIT_FLUSH_INTERVAL)
+        flush_audit_log()
+
+def _start_audit_writer():
+    global _audit_writer
+    if _audit_writer is not None:
+        return
+    with _audit_writer_lock:
+        if _audit_writer is None:
+            _audit_writer = threading.Thread(target=_audit_writer_loop, name='audit-writer', daemon=True)
+            _audit_writer.start()
+
+atexit.register(flush_audit_log)
+
+@app.route('/audit-log')
+@admin_required
+def audit_log():
+    """Admin page listing patient access, filterable by staff number and patient id"""
+    flush_audit_log()
+    staff_number = request.args.get('staff', '').strip()
+    patient_id = request.args.get('patient', type=int)
+    before = request.args.get('before', type=int)
+
+    query = AccessAudit.query
+    if staff_number:
+        query = query.filter_by(staff_number=staff_number)
+    if patient_id:
+        query = query.filter_by(patient_id=patient_id)
+    if before:
+        query = query.filter(AccessAudit.id < before)
+    entries = query.order_by(AccessAudit.id.desc()).limit(AUDIT_PAGE_SIZE + 1).all()
+
+    next_before = None
+    if len(entries) > AUDIT_PAGE_SIZE:
+        entries = entries[:AUDIT_PAGE_SIZE]
+        next_before = entries[-1].id
+
+    return render_template('audit_log.html',
+                           entries=entries,
+                           staff_number=staff_number,
+                           patient_id=patient_id,
+                           next_before=next_before,
+                           stats=audit_stats)
+
+
+# ==================== GROUP COMMIT WRITER ====================
+#
+# Write routes do not commit themselves. They hand commit_write() a small
+# function that adds (or deletes) one row, and a single writer thread runs
+# everything queued within WRITE_BATCH_WINDOW in one transaction: one fsync
+# and one acquisition of SQLite's write lock for the whole batch instead of
+# one per request. Each write is flushed on its own, so a failing write (a
+# duplicate, say) is rolled back and reported to its caller alone while the
+# rest of the batch is retried without it. Callers block on a Future that
+# resolves with their new row id. bench_group_commit.py compares this with
+# committing inline (GROUP_COMMIT off).
+
+WRITE_QUEUE_SIZE = 1000
+WRITE_BATCH_WINDOW = 0.002  # seconds to wait for more writes after the first
+WRITE_BATCH_MAX = 200
+WRITE_TIMEOUT = 30
+
+write_queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+write_stats = {'submitted': 0, 'committed': 0, 'failed': 0, 'batches': 0, 'retries': 0}
+_write_latencies = deque(maxlen=1000)  # seconds from submit to commit, most recent writes
+_write_batch_sizes = deque(maxlen=1000)
+_writer_lock = threading.Lock()
+_writer = None
+
+def commit_write(operation):
+    """Run a write function (which returns the row it added) and commit it; returns the row id"""
+    if not app.config['GROUP_COMMIT']:
+        try:
+            row = operation()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return row.id if row is not None else None
+    _start_writer()
+    future = Future()
+    write_queue.put((current_tenant(), operation, future, time.perf_counter()), timeout=WRITE_TIMEOUT)
+    write_stats['submitted'] += 1
+    return future.result(timeout=WRITE_TIMEOUT)
+
+def _commit_batch(writes):
+    """Commit queued writes in one transaction, dropping and reporting any that fail"""
+    pending = writes
+    while pending:
+        done = []
+        failing = None
+        try:
+            for write in pending:
+                failing = write
+                row = write[0]()
+                db.session.flush()
+                done.append((write, row.id if row is not None else None))
+            failing = None
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            failed = pending if failing is None else [failing]
+            for _, future, _ in failed:
+                future.set_exception(e)
+            write_stats['failed'] += len(failed)
+            pending = [write for write in pending if write not in failed]
+            write_stats['retries'] += 1 if pending else 0
+            continue
+        now = time.perf_counter()
+        for (_, future, submitted), row_id in done:
+            _write_latencies.append(now - submitted)
+            future.set_result(row_id)
+        write_stats['committed'] += len(done)
+        write_stats['batches'] += 1
+        _write_batch_sizes.append(len(done))
+        return
+
+def _writer_loop():
+    while True:
+        batch = [write_queue.get()]
+        deadline = time.monotonic() + WRITE_BATCH_WINDOW
+        while len(batch) < WRITE_BATCH_MAX:
+            try:
+                batch.append(write_queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        by_tenant = {}
+        for tenant, operation, future, submitted in batch:
+            by_tenant.setdefault(tenant, []).append((operation, future, submitted))
+        for tenant, writes in by_tenant.items():
+            try:
+                with tenant_context(tenant):
+                    _commit_batch(writes)
+            except Exception as e:
+                app.logger.exception('Group commit failed for %s', tenant or 'default database')
+                for _, future, _ in writes:
+                    if not future.done():
+                        future.set_exception(e)
+
+def _start_writer():
+    global _writer
+    if _writer is not None:
+        return
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_writer_loop, name='group-commit', daemon=True)
+            _writer.start()
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)] if ordered else 0
+
+def write_metrics():
+    """Group commit counters with latency (ms) and batch size over the most recent writes"""
+    latencies = list(_write_latencies)
+    sizes = list(_write_batch_sizes)
+    return dict(
+        write_stats,
+        enabled=app.config['GROUP_COMMIT'],
+        queued=write_queue.qsize(),
+        latency_ms={
+            'p50': round(_percentile(latencies, 0.5) * 1000, 2),
+            'p95': round(_percentile(latencies, 0.95) * 1000, 2),
+            'max': round(max(latencies, default=0) * 1000, 2),
+        },
+        batch_size={
+            'mean': round(sum(sizes) / len(sizes), 2) if sizes else 0,
+            'max': max(sizes, default=0),
+        },
+    )
+
+
+# ==================== SPECULATIVE PREFETCH ====================
+#
+# Once patient_auth has matched a lookup hash it hands key derivation and
+# decryption to a worker and redirects. The result waits in a slot keyed by a
+# random token kept in the session; patient_records claims it, waiting if it
+# is already running (one still queued is cancelled and the work done inline).
+# A sweeper thread drops slots nobody claims within PREFETCH_TTL, so derived
+# keys and decrypted records never linger in memory.
+
+PREFETCH_WORKERS = 2
+PREFETCH_TTL = 30      # seconds an unclaimed prefetch is kept
+PREFETCH_WAIT = 10     # seconds patient_records waits for a running prefetch
+PREFETCH_SWEEP_INTERVAL = 5
+
+prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix='prefetch')
+prefetch_stats = {'started': 0, 'hits': 0, 'waited': 0, 'misses': 0, 'stale': 0, 'cancelled': 0,
+                  'discarded': 0, 'expired': 0, 'failed': 0}
+_prefetch_slots = {}  # token -> (future, patient_id, started)
+_prefetch_lock = threading.Lock()
+_prefetch_sweeper_lock = threading.Lock()
+_prefetch_sweeper = None
+
+def _decrypt_patient_records(tenant, patient_id, first_name, last_name, dob):
+    """Worker job: derive the patient key and decrypt the patient and visits"""
+    with tenant_context(tenant):
+        patient = db.session.get(Patient, patient_id)
+        if patient is None:
+            return None
+        key = generate_encryption_key(first_name, last_name, dob)
+        # Read before the visits: a visit added in between makes the result stale, never wrongly current
+        stats = visit_stats(patient_id)
+        return {
+            'key': key,
+            'patient': decrypt_with_key(patient.encrypted_data, key),
+            'visits': decrypt_visits(patient.visits, key),
+            'stats': stats,
+        }
+
+def _drop_prefetch(future):
+    """Forget a prefetch: cancel it if it has not started, otherwise let its result go"""
+    if future.cancel():
+        prefetch_stats['cancelled'] += 1
+    else:
+        prefetch_stats['discarded'] += 1
+
+def sweep_prefetch():
+    """Drop every prefetch left unclaimed for longer than PREFETCH_TTL"""
+    now = time.monotonic()
+    with _prefetch_lock:
+        expired = [token for token, (_, _, started) in _prefetch_slots.items() if now - started > PREFETCH_TTL]
+        futures = [_prefetch_slots.pop(token)[0] for token in expired]
+    for future in futures:
+        _drop_prefetch(future)
+        prefetch_stats['expired'] += 1
+
+def _prefetch_sweeper_loop():
+    while True:
+        time.sleep(PREFETCH_SWEEP_INTERVAL)
+        sweep_prefetch()
+
+def _start_prefetch_sweeper():
+    global _prefetch_sweeper
+    if _prefetch_sweeper is not None:
+        return
+    with _prefetch_sweeper_lock:
+        if _prefetch_sweeper is None:
+            _prefetch_sweeper = threading.Thread(target=_prefetch_sweeper_loop, name='prefetch-sweeper', daemon=True)
+            _prefetch_sweeper.start()
+
+def start_prefetch(patient_id, first_name, last_name, dob):
+    """Start decrypting a patient's records for the next patient_records request"""
+    discard_prefetch()
+    _start_prefetch_sweeper()
+    now = time.monotonic()
+    token = secrets.token_urlsafe(16)
+    with _prefetch_lock:
+        future = prefetch_executor.submit(
+            _decrypt_patient_records, current_tenant(), patient_id, first_name, last_name, dob)
+        _prefetch_slots[token] = (future, patient_id, now)
+    session['prefetch_token'] = token
+    prefetch_stats['started'] += 1
+
+def discard_prefetch():
+    """Cancel the session's prefetch, if any"""
+    token = session.pop('prefetch_token', None)
+    if not token:
+        return
+    with _prefetch_lock:
+        slot = _prefetch_slots.pop(token, None)
+    if slot:
+        _drop_prefetch(slot[0])
+
+def take_prefetch(patient_id):
+    """Claim the session's prefetched records, waiting if needed; None if there are none to use"""
+    token = session.pop('prefetch_token', None)
+    if not token:
+        # Follow-up views (after a save, older pages, refreshes) never had a prefetch
+        return None
+    with _prefetch_lock:
+        slot = _prefetch_slots.pop(token, None)
+    if slot is None:
+        return None  # already counted as expired by the sweeper
+    future = slot[0]
+    if slot[1] != patient_id:
+        _drop_prefetch(future)
+        return None
+
+    if not future.done():
+        # Still queued behind other prefetches: decrypting inline is quicker than waiting
+        if future.cancel():
+            prefetch_stats['cancelled'] += 1
+            prefetch_stats['misses'] += 1
+            return None
+        prefetch_stats['waited'] += 1
+    try:
+        result = future.result(timeout=PREFETCH_WAIT)
+    except TimeoutError:
+        _drop_prefetch(future)
+        prefetch_stats['misses'] += 1
+        return None
+    except Exception:
+        result = None
+    if not result or not result['patient']:
+        prefetch_stats['failed'] += 1
+        return None
+    prefetch_stats['hits'] += 1
+    return result
+
+def prefetch_hit_rate():
+    """Share of prefetches that were claimed or expired and saved patient_records the work"""
+    settled = sum(prefetch_stats[name] for name in ('hits', 'misses', 'failed', 'expired'))
+    return round(prefetch_stats['hits'] / settled, 3) if settled else None
+
+
+# ==================== JSON API ====================
+#
+# JSON views of the session's patient so a page can fetch only what changed.
+# The ETag comes from an indexed MAX(id)/COUNT(*) over the patient's visits
+# (plus the patient's change sequence for the summary, which a sync merge can
+# replace without adding a visit), so an unchanged record answers 304 without
+# deriving a key or decrypting.
+
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 200
+GZIP_MIN_SIZE = 512
+
+def json_response(payload, etag=None):
+    """JSON response, gzip-compressed when the client accepts it and it is worth it"""
+    body = json.dumps(payload, separators=(',', ':')).encode()
+    response = Response(body, mimetype='application/json')
+    if len(body) >= GZIP_MIN_SIZE and 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response.set_data(gzip.compress(body))
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'private, no-cache'
+    if etag:
+        response.set_etag(etag)
+    return response
+
+def visit_stats(patient_id):
+    """Highest visit id and number of visits for a patient (index-only query)"""
+    max_id, count = db.session.query(db.func.max(Visit.id), db.func.count(Visit.id)).filter(
+        Visit.patient_id == patient_id).one()
+    return max_id or 0, count
+
+def visits_etag(patient_id, stats, *args):
+    """ETag for the patient's visit history as seen with the given query arguments"""
+    return '-'.join(str(part) for part in (patient_id,) + stats + args)
+
+def not_modified(etag):
+    """304 response if the client already has this version"""
+    if etag in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    return None
+
+@app.route('/api/patient')
+@api_staff_required
+@rate_limited('api')
+def api_patient():
+    """Summary of the session's patient"""
+    patient_id = session['patient_id']
+    patient = db.session.get(Patient, patient_id)
+    if not patient:
+        return jsonify({'error': 'Patient not found.'}), 404
+    stats = visit_stats(patient_id)
+    etag = visits_etag(patient_id, stats, 'summary', patient.change_seq)
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    patient_data = decrypt_with_key(patient.encrypted_data, session_patient_key())
+    if not patient_data:
+        record_access('api_patient', 'decrypt_failed', patient_id=patient_id)
+        return jsonify({'error': 'Unable to decrypt patient record.'}), 403
+
+    physician = Staff.query.filter_by(staff_number=patient.physician_staff_number).first()
+    record_access('api_patient', 'viewed', patient_id=patient_id)
+    return json_response({
+        'id': patient.id,
+        'first_name': patient_data.get('first_name'),
+        'last_name': patient_data.get('last_name'),
+        'dob': patient_data.get('dob'),
+        'sex': patient_data.get('sex'),
+        'physician': {
+            'staff_number': physician.staff_number,
+            'name': f"{physician.first_name} {physician.last_name}",
+        } if physician else None,
+        'visit_count': max(patient.visit_count, stats[1]),  # includes archived visits
+        'latest_visit_id': stats[0] or None,
+    }, etag=etag)
+
+@app.route('/api/visits')
+@api_staff_required
+@rate_limited('api')
+def api_visits():
+    """
+    Visits of the session's patient, newest first.
+    ?since_id=N returns only visits added after N; ?before=N pages back
+    through older visits; ?limit= caps the page size.
+    """
+    patient_id = session['patient_id']
+    since_id = request.args.get('since_id', type=int)
+    before = request.args.get('before', type=int)
+    limit = max(1, min(request.args.get('limit', API_PAGE_SIZE, type=int), API_MAX_PAGE_SIZE))
+
+    stats = visit_stats(patient_id)
+    etag = visits_etag(patient_id, stats, 'visits', since_id, before, limit)
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    query = Visit.query.filter_by(patient_id=patient_id)
+    if since_id is not None:
+        query = query.filter(Visit.id > since_id)
+    if before is not None:
+        query = query.filter(Visit.id < before)
+    rows = query.order_by(Visit.id.desc()).limit(limit + 1).all()
+    patient = db.session.get(Patient, patient_id)
+    if patient and patient.visit_count > stats[1]:
+        # Some visits are archived; page through both (ids can interleave after a sync)
+        rows = sorted(rows + load_archived_visits(patient_id, limit + 1, since_id, before, by_id=True),
+                      key=lambda row: row.id, reverse=True)[:limit + 1]
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    visits = decrypt_visits(rows, session_patient_key()) if rows else []
+    if rows:
+        record_access('api_visits', 'viewed', patient_id=patient_id)
+    return json_response({
+        'visits': visits,
+        'has_more': has_more,
+        'next_before': rows[-1].id if has_more else None,
+        # Older pages say nothing about the newest visit; keep polling from since_id
+        'latest_id': rows[0].id if rows and before is None else since_id,
+    }, etag=etag)
+
+
+# ==================== MULTI-SITE SYNC ====================
+#
+# Each install stamps the patients and visits it writes with its site id and a
+# local change sequence. Desktops push the rows they own to a central server
+# and pull everyone else's, in gzip-compressed batches of ciphertext. Patients
+# are merged on lookup_hash: the earliest registration (created_at, then
+# site_id) wins on every node, so all sites converge on the same record.
+# Visits are append-only and identified by (site_id, origin_id). A merged
+# batch and the cursor that records it commit together, through the group
+# commit writer like every other write.
+
+SYNC_BATCH_SIZE = 2000
+SYNC_CHUNK_SIZE = 500  # keeps IN (...) lists well below SQLite's variable limit
+SYNC_TIMEOUT = 60
+SYNCED_PATIENT_FIELDS = ('lookup_hash', 'encrypted_data', 'physician_staff_number')
+
+def reserve_change_seqs(connection, count=1):
+    """Reserve `count` consecutive change sequence numbers and return the first"""
+    result = connection.execute(
+        text("UPDATE sync_state SET value = value + :count WHERE key = 'change_seq'"),
+        {'count': count})
+    if result.rowcount == 0:
+        connection.execute(
+            text("INSERT INTO sync_state (key, value) VALUES ('change_seq', :count)"),
+            {'count': count})
+    last = connection.execute(text("SELECT value FROM sync_state WHERE key = 'change_seq'")).scalar()
+    return last - count + 1
+
+@event.listens_for(Patient, 'before_insert')
+@event.listens_for(Visit, 'before_insert')
+def stamp_new_row(mapper, connection, target):
+    """Give newly written rows this site's id and a fresh change sequence"""
+    if target.site_id is None:
+        target.site_id = app.config['SITE_ID']
+    if not target.change_seq:
+        target.change_seq = reserve_change_seqs(connection)
+
+@event.listens_for(Patient, 'before_update')
+def stamp_patient_update(mapper, connection, target):
+    """Bump the change sequence when a synced patient field changes"""
+    state = db.inspect(target)
+    if state.attrs.change_seq.history.has_changes():
+        return
+    if any(state.attrs[field].history.has_changes() for field in SYNCED_PATIENT_FIELDS):
+        target.change_seq = reserve_change_seqs(connection)
+
+def get_sync_cursor(key):
+    """Return a stored sync cursor (0 if this server was never synced)"""
+    state = db.session.get(SyncState, key)
+    return state.value if state else 0
+
+def set_sync_cursor(key, value):
+    """Move a sync cursor (committed with the caller's write)"""
+    state = db.session.get(SyncState, key)
+    if state is None:
+        db.session.add(SyncState(key=key, value=value))
+    else:
+        state.value = value
+
+def _chunks(items, size=SYNC_CHUNK_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def _patient_to_wire(patient):
+    return {
+        'lookup_hash': patient.lookup_hash,
+        'encrypted_data': patient.encrypted_data,
+        'physician_staff_number': patient.physician_staff_number,
+        'created_at': patient.created_at.isoformat(),
+        'site_id': patient.site_id,
+    }
+
+def _visit_to_wire(visit, lookup_hash):
+    return {
+        'site_id': visit.site_id,
+        'origin_id': visit.origin_id or visit.id,
+        'patient_lookup_hash': lookup_hash,
+        'encrypted_data': visit.encrypted_data,
+        'visit_date': visit.visit_date.isoformat(),
+    }
+
+def collect_changes(since, limit=SYNC_BATCH_SIZE, only_site=None, exclude_site=None):
+    """
+    Collect patients and visits changed after `since`, oldest change first.
+    Every visit travels with its patient so the receiver can always attach it.
+    """
+    patient_query = Patient.query.filter(Patient.change_seq > since)
+    visit_query = Visit.query.filter(Visit.change_seq > since)
+    if only_site:
+        patient_query = patient_query.filter(Patient.site_id == only_site)
+        visit_query = visit_query.filter(Visit.site_id == only_site)
+    if exclude_site:
+        patient_query = patient_query.filter(Patient.site_id != exclude_site)
+        visit_query = visit_query.filter(Visit.site_id != exclude_site)
+
+    patients = patient_query.order_by(Patient.change_seq).limit(limit).all()
+    visits = visit_query.order_by(Visit.change_seq).limit(limit).all()
+    # Archived visits may not have reached every server yet
+    visits = sorted(visits + archived_changes(since, limit, only_site, exclude_site),
+                    key=lambda row: row.change_seq)[:limit]
+    more = len(patients) + len(visits) > limit or len(patients) == limit or len(visits) == limit
+
+    # Both tables share one sequence, so merge the streams and keep the oldest `limit`
+    rows = sorted(patients + visits, key=lambda row: row.change_seq)[:limit]
+    patients = [row for row in rows if isinstance(row, Patient)]
+    visits = [row for row in rows if not isinstance(row, Patient)]
+
+    by_id = {patient.id: patient for patient in patients}
+    missing = {visit.patient_id for visit in visits} - by_id.keys()
+    for chunk in _chunks(missing):
+        for patient in Patient.query.filter(Patient.id.in_(chunk)):
+            by_id[patient.id] = patient
+
+    return {
+        'patients': [_patient_to_wire(patient) for patient in by_id.values()],
+        'visits': [_visit_to_wire(visit, by_id[visit.patient_id].lookup_hash) for visit in visits],
+        'cursor': rows[-1].change_seq if rows else since,
+        'more': more,
+    }
+
+def apply_changes(patients, visits):
+    """Merge a batch of remote patients and visits into this database (the caller commits)"""
+    local_site = app.config['SITE_ID']
+    # One block of sequence numbers for the whole batch instead of one per row
+    next_seq = reserve_change_seqs(db.session.connection(), len(patients) + len(visits) or 1)
+    created = merged = added = 0
+
+    wanted = {p['lookup_hash'] for p in patients} | {v['patient_lookup_hash'] for v in visits}
+    by_hash = {}
+    for chunk in _chunks(wanted):
+        for patient in Patient.query.filter(Patient.lookup_hash.in_(chunk)):
+            by_hash[patient.lookup_hash] = patient
+
+    for incoming in patients:
+        created_at = datetime.fromisoformat(incoming['created_at'])
+        current = by_hash.get(incoming['lookup_hash'])
+        if current is None:
+            current = Patient(
+                lookup_hash=incoming['lookup_hash'],
+                encrypted_data=incoming['encrypted_data'],
+                physician_staff_number=incoming['physician_staff_number'],
+                created_at=created_at,
+                site_id=incoming['site_id'],
+                change_seq=next_seq
+            )
+            db.session.add(current)
+            by_hash[current.lookup_hash] = current
+            created += 1
+        elif (created_at, incoming['site_id']) < (current.created_at, current.site_id or ''):
+            # The earlier registration is canonical everywhere
+            current.encrypted_data = incoming['encrypted_data']
+            current.physician_staff_number = incoming['physician_staff_number']
+            current.created_at = created_at
+            current.site_id = incoming['site_id']
+            current.change_seq = next_seq
+            merged += 1
+        else:
+            continue
+        next_seq += 1
+
+    db.session.flush()  # assigns ids to new patients before their visits reference them
+
+    remote = {}
+    for incoming in visits:
+        if incoming['site_id'] != local_site:
+            remote.setdefault(incoming['site_id'], set()).add(incoming['origin_id'])
+    seen = set()
+    new_visits = {}  # patient id -> (visits added, latest visit date)
+    for site_id, origin_ids in remote.items():
+        for chunk in _chunks(origin_ids):
+            rows = db.session.query(Visit.origin_id).filter(
+                Visit.site_id == site_id, Visit.origin_id.in_(chunk))
+            seen.update((site_id, origin_id) for origin_id, in rows)
+        seen.update((site_id, origin_id) for origin_id in archived_origin_ids(site_id, origin_ids))
+
+    for incoming in visits:
+        key = (incoming['site_id'], incoming['origin_id'])
+        # Our own visits come back from the server unchanged
+        if incoming['site_id'] == local_site or key in seen:
+            continue
+        patient = by_hash.get(incoming['patient_lookup_hash'])
+        if patient is None:
+            continue
+        db.session.add(Visit(
+            patient_id=patient.id,
+            encrypted_data=incoming['encrypted_data'],
+            visit_date=datetime.fromisoformat(incoming['visit_date']),
+            site_id=incoming['site_id'],
+            origin_id=incoming['origin_id'],
+            change_seq=next_seq
+        ))
+        seen.add(key)
+        next_seq += 1
+        added += 1
+        count, latest = new_visits.get(patient.id, (0, None))
+        visit_date = datetime.fromisoformat(incoming['visit_date'])
+        new_visits[patient.id] = (count + 1, max(latest, visit_date) if latest else visit_date)
+
+    for patient_id, (count, latest) in new_visits.items():
+        record_visit_summary(patient_id, count, latest)
+    return {'patients_created': created, 'patients_merged': merged, 'visits_added': added}
+
+def _gzip_json(payload):
+    return gzip.compress(json.dumps(payload, separators=(',', ':')).encode())
+
+def _gzip_json_response(payload):
+    return Response(_gzip_json(payload), mimetype='application/json',
+                    headers={'Content-Encoding': 'gzip'})
+
+def _read_json_body():
+    body = request.get_data()
+    if request.headers.get('Content-Encoding') == 'gzip':
+        body = gzip.decompress(body)
+    return json.loads(body)
+
+@app.route('/sync/pull')
+@sync_token_required
+def sync_pull():
+    """Send the changes after ?since= to a syncing site, skipping its own rows"""
+    since = request.args.get('since', 0, type=int)
+    limit = max(1, min(request.args.get('limit', SYNC_BATCH_SIZE, type=int), SYNC_BATCH_SIZE))
+    return _gzip_json_response(collect_changes(since, limit, exclude_site=request.args.get('site')))
+
+@app.route('/sync/push', methods=['POST'])
+@sync_token_required
+def sync_push():
+    """Merge a batch of changes pushed by a syncing site"""
+    payload = _read_json_body()
+    result = {}
+
+    def merge_batch():
+        # Runs again if the group commit batch is retried; only the committed pass counts
+        result.update(apply_changes(payload.get('patients', []), payload.get('visits', [])))
+
+    commit_write(merge_batch)
+    return _gzip_json_response(result)
+
+def _sync_request(server_url, path, token, payload=None):
+    headers = {'Authorization': f'Bearer {token}', 'Accept-Encoding': 'gzip'}
+    data = None
+    if payload is not None:
+        data = _gzip_json(payload)
+        headers.update({'Content-Type': 'application/json', 'Content-Encoding': 'gzip'})
+    req = urllib.request.Request(server_url.rstrip('/') + path, data=data, headers=headers)
+    with urllib.request.urlopen(req, timeout=SYNC_TIMEOUT) as response:
+        body = response.read()
+        if response.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+    return json.loads(body)
+
+def sync_with_server(server_url, token=None):
+    """Push this site's changes to a central server, then pull everyone else's"""
+    token = token or app.config.get('SYNC_TOKEN') or ''
+    site_id = app.config['SITE_ID']
+    pushed = pulled = 0
+    with app.app_context():
+        push_key = f'push:{server_url}'
+        cursor = get_sync_cursor(push_key)
+        while True:
+            batch = collect_changes(cursor, only_site=site_id)
+            if batch['cursor'] == cursor:
+                break
+            _sync_request(server_url, '/sync/push', token, batch)
+            cursor = batch['cursor']
+            commit_write(lambda: set_sync_cursor(push_key, cursor))
+            pushed += len(batch['visits']) + len(batch['patients'])
+            if not batch['more']:
+                break
+
+        pull_key = f'pull:{server_url}'
+        cursor = get_sync_cursor(pull_key)
+        while True:
+            query = urllib.parse.urlencode({'since': cursor, 'site': site_id})
+            batch = _sync_request(server_url, f'/sync/pull?{query}', token)
+            if batch['cursor'] == cursor:
+                break
+            cursor = batch['cursor']
+
+            def merge_batch():
+                apply_changes(batch['patients'], batch['visits'])
+                set_sync_cursor(pull_key, cursor)
+
+            commit_write(merge_batch)
+            pulled += len(batch['visits']) + len(batch['patients'])
+            if not batch['more']:
+                break
+    return {'pushed': pushed, 'pulled': pulled}
+
+
+# ==================== VISIT ARCHIVE ====================
+#
+# Visits older than ARCHIVE_AFTER_DAYS are moved out of the hot visit table
+# into a separate medical_records_archive.db next to the main database (or
+# the tenant's database), so the main file, its indexes and its backups stay
+# small. The archive is ATTACHed only while it is used. The archive_visits
+# maintenance job moves rows in short batches, each in its own transaction
+# with a pause in between so writers are never held up for long; every
+# committed batch is final, so an interrupted run simply resumes next time.
+# patient_records() reads the hot table and only loads archived visits when
+# the user pages back to them. Archived visits are still part of the record
+# everywhere else: /api/visits pages into them, sync sends them to servers
+# that have not seen them yet, and incoming visits are checked against them.
+
+ARCHIVE_BATCH_SIZE = 500
+ARCHIVE_BATCH_PAUSE = 0.05  # seconds between batches, for waiting writers
+ARCHIVE_PAGE_SIZE = 25
+
+# Read-side view of the archived visit table (schema 'archive' = the attached file)
+archived_visit = db.Table(
+    'visit', db.MetaData(),
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('patient_id', db.Integer),
+    db.Column('encrypted_data', db.Text),
+    db.Column('visit_date', db.DateTime),
+    db.Column('site_id', db.String(64)),
+    db.Column('origin_id', db.Integer),
+    db.Column('change_seq', db.Integer),
+    schema='archive'
+)
+
+def archive_path():
+    """Archive file belonging to the current (tenant's) main database"""
+    root, ext = os.path.splitext(get_engine().url.database)
+    return f'{root}_archive{ext}'
+
+@contextmanager
+def attached_archive():
+    """A connection with the archive ATTACHed, or None when nothing has been archived"""
+    path = archive_path()
+    if not os.path.exists(path):
+        yield None
+        return
+    with get_engine().connect() as connection:
+        connection.exec_driver_sql('ATTACH DATABASE ? AS archive', (path,))
+        try:
+            archived = connection.exec_driver_sql(
+                "SELECT 1 FROM archive.sqlite_master WHERE type = 'table' AND name = 'visit'").first()
+            yield connection if archived else None
+        finally:
+            connection.rollback()
+            connection.exec_driver_sql('DETACH DATABASE archive')
+
+def archive_available():
+    """Whether the archive can be read (a database copied without it has archived visits counted but missing)"""
+    with attached_archive() as connection:
+        return connection is not None
+
+def load_archived_visits(patient_id, limit, since_id=None, before=None, by_id=False):
+    """The patient's newest archived visits (by date, or by id for API paging)"""
+    columns = archived_visit.c
+    query = db.select(archived_visit).where(columns.patient_id == patient_id)
+    if since_id is not None:
+        query = query.where(columns.id > since_id)
+    if before is not None:
+        query = query.where(columns.id < before)
+    if by_id:
+        query = query.order_by(columns.id.desc())
+    else:
+        query = query.order_by(columns.visit_date.desc(), columns.id.desc())
+    with attached_archive() as connection:
+        if connection is None:
+            return []
+        return connection.execute(query.limit(limit)).all()
+
+def archived_changes(since, limit, only_site=None, exclude_site=None):
+    """Archived visits with a change sequence after `since`, for collect_changes()"""
+    columns = archived_visit.c
+    query = db.select(archived_visit).where(columns.change_seq > since)
+    if only_site:
+        query = query.where(columns.site_id == only_site)
+    if exclude_site:
+        query = query.where(columns.site_id != exclude_site)
+    with attached_archive() as connection:
+        if connection is None:
+            return []
+        return connection.execute(query.order_by(columns.change_seq).limit(limit)).all()
+
+def archived_origin_ids(site_id, origin_ids):
+    """Which of a site's visit origin ids are already in the archive"""
+    columns = archived_visit.c
+    found = set()
+    with attached_archive() as connection:
+        if connection is None:
+            return found
+        for chunk in _chunks(origin_ids):
+            found.update(connection.execute(
+                db.select(columns.origin_id).where(columns.site_id == site_id, columns.origin_id.in_(chunk))
+            ).scalars())
+    return found
+
+def _ensure_archive_schema(connection):
+    """Create the archived visit table, or add columns the visit table has gained since"""
+    dialect = get_engine().dialect
+    existing = {row[1] for row in connection.execute('PRAGMA archive.table_info(visit)')}
+    columns = Visit.__table__.columns
+    if not existing:
+        definitions = ', '.join(
+            f'{column.name} {column.type.compile(dialect=dialect)}' + (' PRIMARY KEY' if column.primary_key else '')
+            for column in columns
+        )
+        connection.execute(f'CREATE TABLE archive.visit ({definitions})')
+    else:
+        for column in columns:
+            if column.name not in existing:
+                connection.execute(
+                    f'ALTER TABLE archive.visit ADD COLUMN {column.name} {column.type.compile(dialect=dialect)}')
+    connection.execute('CREATE INDEX IF NOT EXISTS archive.ix_archive_visit_patient ON visit (patient_id, visit_date)')
+    connection.execute('CREATE INDEX IF NOT EXISTS archive.ix_archive_visit_change_seq ON visit (change_seq)')
+    connection.execute('CREATE INDEX IF NOT EXISTS archive.ix_archive_visit_site_origin ON visit (site_id, origin_id)')
+
+def _archive_visits(connection):
+    cutoff = (datetime.utcnow() - timedelta(days=app.config['ARCHIVE_AFTER_DAYS'])).strftime('%Y-%m-%d %H:%M:%S')
+    column_list = ', '.join(column.name for column in Visit.__table__.columns)
+    connection.execute('ATTACH DATABASE ? AS archive', (archive_path(),))
+    moved = 0
+    try:
+        _ensure_archive_schema(connection)
+        while True:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                # The newest visit always stays hot: SQLite hands out ids after the
+                # current maximum, so new visits can never reuse an archived id
+                ids = [row[0] for row in connection.execute(
+                    'SELECT id FROM main.visit WHERE visit_date < ? '
+                    'AND id < (SELECT MAX(id) FROM main.visit) ORDER BY id LIMIT ?',
+                    (cutoff, ARCHIVE_BATCH_SIZE))]
+                if ids:
+                    placeholders = ', '.join('?' * len(ids))
+                    connection.execute(
+                        f'INSERT OR REPLACE INTO archive.visit ({column_list}) '
+                        f'SELECT {column_list} FROM main.visit WHERE id IN ({placeholders})', ids)
+                    connection.execute(f'DELETE FROM main.visit WHERE id IN ({placeholders})', ids)
+                connection.execute('COMMIT')
+            except BaseException:
+                if connection.in_transaction:  # an interrupted statement has already rolled back
+                    connection.execute('ROLLBACK')
+                raise
+            if not ids:
+                break
+            moved += len(ids)
+            time.sleep(ARCHIVE_BATCH_PAUSE)
+    finally:
+        connection.execute('DETACH DATABASE archive')
+    return f'{moved} visits older than {cutoff[:10]} archived'
+
+
+# ==================== DATABASE MAINTENANCE ====================
+#
+# A background scheduler keeps long-running installs healthy. Once the app
+# has been idle for MAINTENANCE_IDLE_SECONDS it runs the most overdue job,
+# one per tick. Each job runs under a time budget enforced by SQLite's
+# progress handler (an interrupted statement rolls back cleanly), and every
+# run is recorded in MaintenanceRun. Admins can run any job from staff_admin;
+# jobs without an interval (the full vacuum rebuild) only run that way.
+# Patient databases keep SQLite's default rollback journal rather than WAL: archive
+# batches rely on commits being atomic across ATTACHed files, which WAL does
+# not provide, and desktop installs are shared by copying the .db file alone.
+
+MAINTENANCE_TICK = 60
+MAINTENANCE_IDLE_SECONDS = 120
+VACUUM_PAGES_PER_RUN = 2000
+VACUUM_FREE_RATIO = 0.1  # rebuild a non-incremental database once 10% of it is free pages
+VACUUM_REBUILD_MAX_BYTES = 256 * 1024 * 1024  # larger rebuilds would not fit the scheduled budget
+
+_last_request_at = time.monotonic()
+_maintenance_lock = threading.Lock()
+_maintenance_start_lock = threading.Lock()
+_maintenance_scheduler = None
+
+def _pragma(connection, name):
+    return connection.execute(f'PRAGMA {name}').fetchone()[0]
+
+def _optimize(connection):
+    connection.execute('PRAGMA optimize')
+    return 'query planner statistics updated where needed'
+
+def _analyze(connection):
+    # Sample at most ~1000 rows per index so ANALYZE stays cheap on large tables
+    connection.execute('PRAGMA analysis_limit = 1000')
+    connection.execute('ANALYZE')
+    return 'statistics rebuilt'
+
+def _incremental_vacuum(connection):
+    free_pages = _pragma(connection, 'freelist_count')
+    page_count = _pragma(connection, 'page_count')
+    if _pragma(connection, 'auto_vacuum') == 2:
+        connection.executescript(f'PRAGMA incremental_vacuum({VACUUM_PAGES_PER_RUN})')
+        return f'{free_pages - _pragma(connection, "freelist_count")} of {free_pages} free pages released'
+    if page_count and free_pages / page_count >= VACUUM_FREE_RATIO:
+        # Databases created before incremental vacuum need one full rebuild to switch
+        if page_count * _pragma(connection, 'page_size') <= VACUUM_REBUILD_MAX_BYTES:
+            return _rebuild(connection)
+        return (f'{free_pages} free pages, but the database is too large to rebuild in the background; '
+                'start Vacuum Rebuild from Staff Admin')
+    return f'{free_pages} free pages, nothing to release'
+
+def _rebuild(connection):
+    free_pages = _pragma(connection, 'freelist_count')
+    connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    connection.execute('VACUUM')
+    return f'database rebuilt, {free_pages} free pages released, incremental vacuum enabled'
+
+def _integrity_check(connection):
+    problems = [row[0] for row in connection.execute('PRAGMA quick_check(20)')]
+    if problems != ['ok']:
+        raise RuntimeError('; '.join(problems))
+    return 'no problems found'
+
+MAINTENANCE_JOBS = {
+    'optimize': {'interval': 24 * 60 * 60, 'budget': 10, 'run': _optimize},
+    'analyze': {'interval': 7 * 24 * 60 * 60, 'budget': 30, 'run': _analyze},
+    'incremental_vacuum': {'interval': 7 * 24 * 60 * 60, 'budget': 30, 'run': _incremental_vacuum},
+    'integrity_check': {'interval': 7 * 24 * 60 * 60, 'budget': 60, 'run': _integrity_check},
+    'archive_visits': {'interval': 24 * 60 * 60, 'budget': 60, 'run': _archive_visits},
+    # Blocks writers while it runs, so only an admin starts it
+    'vacuum_rebuild': {'interval': None, 'budget': 15 * 60, 'run': _rebuild},
+}
+
+def run_maintenance_job(name):
+    """Run one maintenance job within its time budget and record the outcome"""
+    job = MAINTENANCE_JOBS[name]
+    started_at = datetime.utcnow()
+    start = time.monotonic()
+    deadline = start + job['budget']
+    with _maintenance_lock:
+        with get_engine().connect() as connection:
+            connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+            raw = connection.connection.driver_connection
+            raw.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+            try:
+                detail = job['run'](raw)
+                outcome = 'ok'
+            except sqlite3.OperationalError as e:
+                if 'interrupted' in str(e):
+                    outcome, detail = 'timeout', f"stopped at the {job['budget']}s time budget"
+                else:
+                    outcome, detail = 'failed', str(e)
+            except Exception as e:
+                outcome, detail = 'failed', str(e)
+            finally:
+                raw.set_progress_handler(None, 0)
+
+    run = MaintenanceRun(
+        job=name,
+        started_at=started_at,
+        duration_ms=int((time.monotonic() - start) * 1000),
+        outcome=outcome,
+        detail=detail
+    )
+    # Committed here rather than through commit_write(): jobs only run while the
+    # server is idle, and the writer thread would reopen a tenant that has closed
+    db.session.add(run)
+    db.session.commit()
+    return run
+
+def due_maintenance_job():
+    """Name of the most overdue maintenance job, or None if nothing is due"""
+    now = datetime.utcnow()
+    last_runs = dict(db.session.query(MaintenanceRun.job, db.func.max(MaintenanceRun.started_at))
+                     .group_by(MaintenanceRun.job))
+    overdue, name = max(
+        ((now - last_runs.get(name, datetime.min)).total_seconds() - job['interval'], name)
+        for name, job in MAINTENANCE_JOBS.items() if job['interval'] is not None
+    )
+    return name if overdue >= 0 else None
+
+def run_scheduled_maintenance():
+    """One scheduler tick: close idle tenants, then run the most overdue job for each open database"""
+    tenant_engines.close_idle()
+    for tenant in active_tenants():
+        try:
+            with tenant_context(tenant, scheduled=True):
+                name = due_maintenance_job()
+                if name:
+                    run_maintenance_job(name)
+        except TenantClosed:
+            continue
+        except Exception:
+            app.logger.exception('Database maintenance failed for %s', tenant or 'default database')
+
+def _maintenance_loop():
+    while True:
+        time.sleep(MAINTENANCE_TICK)
+        if time.monotonic() - _last_request_at >= MAINTENANCE_IDLE_SECONDS:
+            run_scheduled_maintenance()
+
+def _start_maintenance_scheduler():
+    global _maintenance_scheduler
+    if _maintenance_scheduler is not None:
+        return
+    with _maintenance_start_lock:
+        if _maintenance_scheduler is None:
+            _maintenance_scheduler = threading.Thread(target=_maintenance_loop, name='db-maintenance', daemon=True)
+            _maintenance_scheduler.start()
+
+@app.before_request
+def note_activity():
+    """Remember when the app was last busy so maintenance waits for idle time"""
+    global _last_request_at
+    _last_request_at = time.monotonic()
+    _start_maintenance_scheduler()
+
+
+# ==================== SCHEMA MIGRATIONS ====================
+#
+# create_all() only creates missing tables, so every column or index added to
+# an existing table ships as a numbered step in MIGRATIONS. migrate() runs the
+# steps the database has not finished yet, in order, and records each one in
+# schema_migration. It runs from init_db() in both apps and when a tenant is
+# first opened. Every step is idempotent. Columns are only added when
+# missing, indexes use IF NOT EXISTS, and backfills only touch rows that
+# still need them. Backfills commit every MIGRATION_BATCH_SIZE rows and
+# record their position, so an interrupted startup resumes where it stopped.
+# Two processes starting at once at worst repeat a little work.
+
+MIGRATION_BATCH_SIZE = 5000
+
+def add_column(table_name, column_name):
+    """ALTER TABLE ... ADD COLUMN unless the column already exists"""
+    engine = get_engine()
+    existing = {column['name'] for column in db.inspect(engine).get_columns(table_name)}
+    if column_name in existing:
+        return
+    column = db.metadata.tables[table_name].columns[column_name]
+    column_type = column.type.compile(dialect=engine.dialect)
+    try:
+        db.session.execute(text(f'ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}'))
+        db.session.commit()
+    except OperationalError as e:
+        db.session.rollback()
+        if 'duplicate column' not in str(e):  # else added by another process just now
+            raise
+
+def add_indexes(*names):
+    """CREATE INDEX IF NOT EXISTS for the named model indexes"""
+    indexes = {index.name: index for table in db.metadata.sorted_tables for index in table.indexes}
+    for name in names:
+        db.session.execute(CreateIndex(indexes[name], if_not_exists=True))
+    db.session.commit()
+
+def backfill(migration, table_name, assignments, pending, params=None):
+    """UPDATE rows matching `pending` in id order, committing one chunk at a time"""
+    last_id = db.session.execute(text(f'SELECT MAX(id) FROM {table_name}')).scalar() or 0
+    while migration.progress < last_id:
+        upper = db.session.execute(text(
+            f'SELECT MAX(id) FROM (SELECT id FROM {table_name} WHERE id > :after ORDER BY id LIMIT :limit)'),
+            {'after': migration.progress, 'limit': MIGRATION_BATCH_SIZE}).scalar()
+        if upper is None:
+            break
+        db.session.execute(text(
+            f'UPDATE {table_name} SET {assignments} WHERE id > :after AND id <= :upper AND ({pending})'),
+            dict(params or {}, after=migration.progress, upper=upper))
+        migration.progress = upper
+        db.session.commit()
+        if last_id > MIGRATION_BATCH_SIZE:
+            print(f"Migration {migration.version} ({migration.name}): {table_name} {upper}/{last_id}")
+
+def _add_sync_columns(migration):
+    for table_name, column_name in [('patient', 'site_id'), ('patient', 'change_seq'),
+                                    ('visit', 'site_id'), ('visit', 'origin_id'), ('visit', 'change_seq')]:
+        add_column(table_name, column_name)
+    add_indexes('ix_patient_change_seq', 'ix_visit_change_seq', 'ix_visit_site_origin')
+
+def _backfill_patient_sync(migration):
+    # Existing rows belong to this site and all need to be pushed on the first sync
+    backfill(migration, 'patient', 'site_id = COALESCE(site_id, :site), change_seq = id',
+             'change_seq IS NULL', {'site': app.config['SITE_ID']})
+
+def _backfill_visit_sync(migration):
+    # Numbered after every patient, so visits are pushed after their patients
+    backfill(migration, 'visit',
+             'site_id = COALESCE(site_id, :site), '
+             'change_seq = id + (SELECT COALESCE(MAX(id), 0) FROM patient)',
+             'change_seq IS NULL', {'site': app.config['SITE_ID']})
+
+def _seed_change_seq(migration):
+    db.session.execute(text("INSERT OR IGNORE INTO sync_state (key, value) VALUES ('change_seq', 0)"))
+    db.session.execute(text(
+        "UPDATE sync_state SET value = MAX(value, "
+        "(SELECT COALESCE(MAX(change_seq), 0) FROM patient), "
+        "(SELECT COALESCE(MAX(change_seq), 0) FROM visit)) WHERE key = 'change_seq'"))
+    db.session.commit()
+
+def _add_visit_lookup_indexes(migration):
+    # Loading a patient's visits, and finding visits old enough to archive
+    add_indexes('ix_visit_patient_id', 'ix_visit_visit_date')
+
+def _add_visit_summary_columns(migration):
+    add_column('patient', 'visit_count')
+    add_column('patient', 'last_visit_at')
+    add_indexes('ix_patient_physician_panel')
+
+def _backfill_visit_summary(migration):
+    backfill(migration, 'patient',
+             'visit_count = (SELECT COUNT(*) FROM visit WHERE visit.patient_id = patient.id), '
+             'last_visit_at = (SELECT MAX(visit_date) FROM visit WHERE visit.patient_id = patient.id)',
+             'visit_count IS NULL')
+
+MIGRATIONS = [
+    (1, 'sync columns', _add_sync_columns),
+    (2, 'patient sync backfill', _backfill_patient_sync),
+    (3, 'visit sync backfill', _backfill_visit_sync),
+    (4, 'change sequence counter', _seed_change_seq),
+    (5, 'visit lookup indexes', _add_visit_lookup_indexes),  # the summary backfill relies on them
+    (6, 'visit summary columns', _add_visit_summary_columns),
+    (7, 'visit summary backfill', _backfill_visit_summary),
+]
+
+def migrate():
+    """Apply every unfinished migration to the current (tenant's) database, in order"""
+    migrations = {migration.version: migration for migration in SchemaMigration.query}
+    for version, name, step in MIGRATIONS:
+        migration = migrations.get(version)
+        if migration is None:
+            migration = SchemaMigration(version=version, name=name, progress=0)
+            db.session.add(migration)
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # Another process started this migration at the same moment
+                db.session.rollback()
+                migration = db.session.get(SchemaMigration, version)
+        if migration.applied_at is not None:
+            continue
+        if migration.progress:
+            print(f"Resuming migration {version} ({name}) after row {migration.progress}")
+        step(migration)
+        migration.applied_at = datetime.utcnow()
+        db.session.commit()
+
+def schema_version():
+    """Highest finished migration of the current (tenant's) database"""
+    return db.session.query(db.func.max(SchemaMigration.version)).filter(
+        SchemaMigration.applied_at.isnot(None)).scalar() or 0
+
 
 # ==================== INITIALIZATION ====================
 
+def setup_database():
+    """Create and upgrade the current (tenant's) databases and the default admin"""
+    with get_engine().begin() as connection:
+        # Only takes effect on a new, empty database file
+        connection.exec_driver_sql('PRAGMA auto_vacuum = INCREMENTAL')
+        db.metadata.create_all(connection)
+    for bind_key, metadata in db.metadatas.items():
+        metadata.create_all(get_engine(bind_key))
+    migrate()
+    
+    # Create default admin if no staff exists
+    if Staff.query.count() == 0:
+        default_admin = Staff(
+            staff_number='ADMIN001',
+            first_name='System',
+            last_name='Administrator',
+            is_admin=True
+        )
+        db.session.add(default_admin)
+        db.session.commit()
+        print("Default admin created: Staff Number: ADMIN001, Last Name: Administrator")
+
 def init_db():
     """Initialize database and create default admin if none exists"""
     with app.app_context():
-        db.create_all()
-        
-        # Create default admin if no staff exists
-        if Staff.query.count() == 0:
-            default_admin = Staff(
-                staff_number='ADMIN001',
-                first_name='System',
-                last_name='Administrator',
-                is_admin=True
-            )
-            db.session.add(default_admin)
-            db.session.commit()
-            print("Default admin created: Staff Number: ADMIN001, Last Name: Administrator")
+        if app.config['TENANT_MODE']:
+            # Tenant databases are set up when each tenant is first used
+            return
+        setup_database()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,106 @@
+"""
+Benchmark: group commit vs inline commits for concurrent visit inserts.
+
+Runs the same add_visit-style write (insert a visit, update the patient's
+visit summary) from several threads, first committing inline in each thread
+and then through the group-commit writer, against a scratch database.
+
+    python bench_group_commit.py [--threads 16] [--writes 100]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+# Run against a throwaway tenant database so real data is never touched
+os.environ['VITALSIGNS_TENANT_MODE'] = 'path'
+os.environ['VITALSIGNS_TENANTS'] = 'bench-inline,bench-group'
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import app as vitalsigns  # noqa: E402
+
+app = vitalsigns.app
+db = vitalsigns.db
+
+
+def _add(row):
+    db.session.add(row)
+    return row
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def run(tenant, group_commit, threads, writes):
+    app.config['GROUP_COMMIT'] = group_commit
+    with vitalsigns.tenant_context(tenant):
+        patient_id = vitalsigns.commit_write(lambda: _add(vitalsigns.Patient(
+            lookup_hash=f'bench-{tenant}',
+            encrypted_data='x',
+            physician_staff_number='ADMIN001'
+        )))
+
+    latencies = []
+    errors = []
+    start_barrier = threading.Barrier(threads)
+
+    def insert_visit():
+        visit = vitalsigns.Visit(patient_id=patient_id, encrypted_data='x' * 400,
+                                 visit_date=vitalsigns.datetime.utcnow())
+        db.session.add(visit)
+        vitalsigns.record_visit_summary(patient_id, 1, visit.visit_date)
+        return visit
+
+    def worker():
+        with vitalsigns.tenant_context(tenant):
+            start_barrier.wait()
+            for _ in range(writes):
+                started = time.perf_counter()
+                try:
+                    vitalsigns.commit_write(insert_visit)
+                except Exception as e:
+                    errors.append(type(e).__name__)
+                    continue
+                latencies.append(time.perf_counter() - started)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    label = 'group commit' if group_commit else 'inline commit'
+    print(f'{label:>14}: {len(latencies) / elapsed:8.0f} writes/s   '
+          f'p50 {percentile(latencies, 0.5) * 1000:7.1f} ms   '
+          f'p95 {percentile(latencies, 0.95) * 1000:7.1f} ms   '
+          f'errors {len(errors)}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--writes', type=int, default=100, help='writes per thread')
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix='vitalsigns-bench-')
+    app.config['TENANT_DATA_DIR'] = data_dir
+    try:
+        print(f'{args.threads} threads x {args.writes} writes')
+        run('bench-inline', False, args.threads, args.writes)
+        run('bench-group', True, args.threads, args.writes)
+        metrics = vitalsigns.write_metrics()
+        print(f"group commit batches: mean {metrics['batch_size']['mean']}, max {metrics['batch_size']['max']}")
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+"""
+Multi-site sync, end to end: a central app.py served over HTTP in a thread and
+two site installs syncing through it.
+
+Every node is its own copy of app.py in a temporary directory, so each one gets
+its own instance/ databases and site id.
+
+    python -m pytest tests/test_sync.py
+"""
+
+import importlib.util
+import itertools
+import shutil
+import sys
+import threading
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+from werkzeug.serving import make_server
+
+APP_PATH = Path(__file__).resolve().parent.parent / 'app.py'
+SYNC_TOKEN = 'test-sync-token'
+_node_ids = itertools.count()
+
+
+def load_node(directory, site_id, monkeypatch):
+    """Import a fresh copy of app.py as an independent install with its own databases"""
+    directory.mkdir()
+    shutil.copy(APP_PATH, directory / 'app.py')
+    monkeypatch.setenv('VITALSIGNS_SITE_ID', site_id)
+    monkeypatch.setenv('VITALSIGNS_SYNC_TOKEN', SYNC_TOKEN)
+    monkeypatch.delenv('VITALSIGNS_TENANT_MODE', raising=False)
+    monkeypatch.delenv('VITALSIGNS_RATE_LIMIT_DB', raising=False)
+
+    name = f'vitalsigns_{site_id.replace("-", "_")}_{next(_node_ids)}'
+    spec = importlib.util.spec_from_file_location(name, directory / 'app.py')
+    node = importlib.util.module_from_spec(spec)
+    sys.modules[name] = node
+    spec.loader.exec_module(node)
+    node.init_db()
+    return node
+
+
+@pytest.fixture
+def nodes(tmp_path, monkeypatch):
+    """(central, site_a, site_b, server_url) with the central app listening on localhost"""
+    central = load_node(tmp_path / 'central', 'central', monkeypatch)
+    site_a = load_node(tmp_path / 'site-a', 'site-a', monkeypatch)
+    site_b = load_node(tmp_path / 'site-b', 'site-b', monkeypatch)
+
+    server = make_server('127.0.0.1', 0, central.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield central, site_a, site_b, f'http://127.0.0.1:{server.port}'
+
+    server.shutdown()
+    thread.join()
+    for node in (central, site_a, site_b):
+        with node.app.app_context():
+            for engine in node.db.engines.values():
+                engine.dispose()
+        sys.modules.pop(node.__name__, None)
+
+
+def add_patient(node, lookup_hash, data, created_at=None):
+    with node.app.app_context():
+        patient = node.Patient(
+            lookup_hash=lookup_hash,
+            encrypted_data=data,
+            physician_staff_number='ADMIN001',
+            created_at=created_at or datetime.utcnow()
+        )
+        node.db.session.add(patient)
+        node.db.session.commit()
+        return patient.id
+
+
+def add_visits(node, lookup_hash, count):
+    with node.app.app_context():
+        patient = node.Patient.query.filter_by(lookup_hash=lookup_hash).one()
+        visit_date = datetime.utcnow()
+        node.db.session.add_all(
+            node.Visit(patient_id=patient.id, encrypted_data=f'visit-{i}', visit_date=visit_date)
+            for i in range(count)
+        )
+        node.record_visit_summary(patient.id, count, visit_date)
+        node.db.session.commit()
+
+
+def visit_keys(node):
+    with node.app.app_context():
+        rows = node.db.session.query(node.Visit.site_id, node.Visit.origin_id, node.Visit.id)
+        return sorted((site_id, origin_id or visit_id) for site_id, origin_id, visit_id in rows)
+
+
+def patient_data(node, lookup_hash):
+    with node.app.app_context():
+        patient = node.Patient.query.filter_by(lookup_hash=lookup_hash).one()
+        return patient.encrypted_data, patient.site_id
+
+
+def cursor(node, key):
+    with node.app.app_context():
+        return node.get_sync_cursor(key)
+
+
+def test_visits_reach_every_site(nodes):
+    central, site_a, site_b, url = nodes
+    add_patient(site_a, 'hash-1', 'patient-a')
+    add_visits(site_a, 'hash-1', 2)
+    add_patient(site_b, 'hash-2', 'patient-b')
+    add_visits(site_b, 'hash-2', 1)
+
+    assert site_a.sync_with_server(url) == {'pushed': 3, 'pulled': 0}
+    assert site_b.sync_with_server(url) == {'pushed': 2, 'pulled': 3}
+    assert site_a.sync_with_server(url) == {'pushed': 0, 'pulled': 2}
+
+    expected = [('site-a', 1), ('site-a', 2), ('site-b', 1)]
+    assert visit_keys(central) == visit_keys(site_a) == visit_keys(site_b) == expected
+    with site_b.app.app_context():
+        assert site_b.Patient.query.filter_by(lookup_hash='hash-1').one().visit_count == 2
+
+
+def test_cursors_only_send_new_changes(nodes):
+    central, site_a, site_b, url = nodes
+    add_patient(site_a, 'hash-1', 'patient-a')
+    add_visits(site_a, 'hash-1', 2)
+    site_a.sync_with_server(url)
+
+    with site_a.app.app_context():
+        own_seq = site_a.db.session.query(site_a.db.func.max(site_a.Visit.change_seq)).scalar()
+    assert cursor(site_a, f'push:{url}') == own_seq
+    assert cursor(site_a, f'pull:{url}') == 0  # nothing from other sites yet
+
+    site_b.sync_with_server(url)
+    with central.app.app_context():
+        central_seq = central.db.session.query(central.db.func.max(central.Visit.change_seq)).scalar()
+    assert cursor(site_b, f'pull:{url}') == central_seq
+
+    # Nothing new on either side: both cursors hold
+    assert site_a.sync_with_server(url) == {'pushed': 0, 'pulled': 0}
+    assert site_b.sync_with_server(url) == {'pushed': 0, 'pulled': 0}
+
+    # Only the new visit (and the patient it belongs to) travel on the next sync
+    add_visits(site_a, 'hash-1', 1)
+    assert site_a.sync_with_server(url) == {'pushed': 2, 'pulled': 0}
+    assert site_b.sync_with_server(url) == {'pushed': 0, 'pulled': 2}
+    assert len(visit_keys(site_b)) == 3
+
+
+def test_resent_visits_are_not_duplicated(nodes):
+    central, site_a, site_b, url = nodes
+    add_patient(site_a, 'hash-1', 'patient-a')
+    add_visits(site_a, 'hash-1', 3)
+    site_a.sync_with_server(url)
+    site_b.sync_with_server(url)
+
+    # A lost response makes a site push the same batch again
+    with site_a.app.app_context():
+        site_a.set_sync_cursor(f'push:{url}', 0)
+    site_a.sync_with_server(url)
+    with site_a.app.app_context():
+        batch = site_a.collect_changes(0, only_site='site-a')
+    assert site_a._sync_request(url, '/sync/push', SYNC_TOKEN, batch)['visits_added'] == 0
+
+    # ...or pull everything from the start
+    with site_b.app.app_context():
+        site_b.set_sync_cursor(f'pull:{url}', 0)
+    site_b.sync_with_server(url)
+
+    expected = [('site-a', 1), ('site-a', 2), ('site-a', 3)]
+    assert visit_keys(central) == visit_keys(site_b) == expected
+    with central.app.app_context():
+        assert central.Patient.query.one().visit_count == 3
+
+
+def test_earliest_registration_wins_everywhere(nodes):
+    central, site_a, site_b, url = nodes
+    registered = datetime(2024, 1, 1, 9, 0)
+    # Registered at the same moment on both sites: the lower site id breaks the tie
+    add_patient(site_a, 'hash-tie', 'from-a', registered)
+    add_patient(site_b, 'hash-tie', 'from-b', registered)
+    # Registered earlier on site-b: the earlier registration wins despite the site id
+    add_patient(site_a, 'hash-early', 'from-a', registered + timedelta(hours=1))
+    add_patient(site_b, 'hash-early', 'from-b', registered)
+
+    site_a.sync_with_server(url)
+    site_b.sync_with_server(url)
+    site_a.sync_with_server(url)
+
+    for node in (central, site_a, site_b):
+        assert patient_data(node, 'hash-tie') == ('from-a', 'site-a')
+        assert patient_data(node, 'hash-early') == ('from-b', 'site-b')
+
+
+def test_batches_split_above_sync_batch_size(nodes):
+    central, site_a, site_b, url = nodes
+    limit = site_a.SYNC_BATCH_SIZE
+
+    # Exactly one batch worth of rows: one patient and limit - 1 visits
+    add_patient(site_a, 'hash-full', 'patient-full')
+    add_visits(site_a, 'hash-full', limit - 1)
+    with site_a.app.app_context():
+        batch = site_a.collect_changes(0, only_site='site-a')
+        assert len(batch['patients']) + len(batch['visits']) == limit
+        assert batch['more'] is False
+
+    # One more row no longer fits
+    add_visits(site_a, 'hash-full', 1)
+    with site_a.app.app_context():
+        first = site_a.collect_changes(0, only_site='site-a')
+        assert len(first['visits']) == limit - 1
+        assert first['more'] is True
+        second = site_a.collect_changes(first['cursor'], only_site='site-a')
+        assert [visit['origin_id'] for visit in second['visits']] == [limit]
+        assert second['more'] is False
+        assert site_a.collect_changes(second['cursor'], only_site='site-a')['visits'] == []
+
+    assert site_a.sync_with_server(url)['pushed'] == limit + 2  # the patient travels with both batches
+    assert site_b.sync_with_server(url)['pulled'] == limit + 2
+    assert len(visit_keys(central)) == len(visit_keys(site_b)) == limit
+    with site_b.app.app_context():
+        assert site_b.Patient.query.one().visit_count == limit
+
+
+def test_pull_limit_is_clamped(nodes):
+    central, site_a, site_b, url = nodes
+    add_patient(site_a, 'hash-1', 'patient-a')
+    add_visits(site_a, 'hash-1', 2)
+    site_a.sync_with_server(url)
+
+    for limit in (-1, 0):
+        batch = site_b._sync_request(url, f'/sync/pull?since=0&site=site-b&limit={limit}', SYNC_TOKEN)
+        assert len(batch['patients']) == 1 and batch['visits'] == []
+        assert batch['more'] is True